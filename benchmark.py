@@ -0,0 +1,488 @@
+#benchmarks generation on tiny random-weight GPT-2 and GPT-Neo models, so it runs anywhere without downloading a model
+#must be run from the clover-edition directory, like test-models.py
+#usage: python benchmark.py [--quick] [--models gpt2,gpt2-experimental,gpt-neo] [--output results.json] [--baseline old.json]
+#results are written as json, pass an earlier results file as --baseline to see what changed
+#it also checks that the optimized code paths give the same results as the reference ones, and exits with 1 if not
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from getconfig import settings
+settings['log-level'] = '30'
+settings['prompt-toolkit'] = 'off'  # no streaming to the terminal
+settings['fast-load'] = 'off'  # nothing to gain on a model this small
+import torch
+from transformers import GPT2Config, GPT2LMHeadModel, GPTNeoConfig, GPTNeoForCausalLM
+
+import gpt2
+from gpt2generator import GPT2Generator, DTYPE, memory_merge, top_k_top_p_filtering, top_k_top_p_candidates, \
+    repetition_penalty_curve, RepetitionPenalty
+from profiler import tracer
+from storymanager import Story
+from utils import first_to_second_person, second_to_first_person
+
+try:
+    from transformers.models.gpt2.tokenization_gpt2 import bytes_to_unicode
+except ImportError:
+    from transformers.tokenization_gpt2 import bytes_to_unicode
+
+VOCAB_SIZE = 50257
+MODELS = ("gpt2", "gpt2-experimental", "gpt-neo")
+TEST_SCRIPTS = ("test-sampling.py", "test-attention.py", "test-text.py", "test-journal.py", "test-detokenizer.py")
+SAMPLERS = {
+    "default": dict(temperature=0.6, top_k=40, top_p=0.9, repetition_penalty=1.25),
+    "top-p": dict(temperature=0.6, top_k=0, top_p=0.9, repetition_penalty=1.25),
+    "no-penalty": dict(temperature=0.6, top_k=40, top_p=0.9, repetition_penalty=1.0),
+    "greedy": dict(temperature=0, top_k=40, top_p=0.9, repetition_penalty=1.25),
+}
+WORDS = ("the you a of and to in it is was he that for on are with as his they be at one have this from or had by "
+         "sword dragon castle forest door light dark old stone king village river night walk look say open take "
+         "slowly suddenly quietly.").split()
+
+
+def story_text(n_words, seed=0):
+    """Deterministic word salad, with some punctuation so sentences can be cut."""
+    rng = random.Random(seed)
+    words = [rng.choice(WORDS) for _ in range(n_words)]
+    return ' '.join(w + '.' if rng.random() < 0.08 else w for w in words).capitalize()
+
+
+def dialogue_text(n_chars, seed=0):
+    """A story told in the first person and mostly in quotes, the hardest case for the pronoun mappings."""
+    rng = random.Random(seed)
+    lines = ('"I am not going back," I say. "You know what they did to me."', "I draw my sword. We wait.",
+             '"Are you sure?" she asks. "I was there, I saw it myself."', "I'm ready, my friends are with me.",
+             '"Who are you?" he asks. "I\'ll tell you," I say.')
+    text = ""
+    while len(text) < n_chars:
+        text += rng.choice(lines) + " "
+    return text
+
+
+def rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except OSError:
+        return None
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def sync():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def allocations(fn):
+    """
+    MB the tensor allocator handed out while fn ran, and in how many allocations. Exact on cuda, on the cpu it's
+    what the profiler sees each op allocate, without the temporaries an op frees before returning.
+    """
+    if torch.cuda.is_available():
+        sync()
+        before = torch.cuda.memory_stats()
+        fn()
+        sync()
+        after = torch.cuda.memory_stats()
+        return ((after["allocated_bytes.all.allocated"] - before["allocated_bytes.all.allocated"]) / 2 ** 20,
+                after["allocation.all.allocated"] - before["allocation.all.allocated"])
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as profile:
+        fn()
+    sizes = [event.self_cpu_memory_usage for event in profile.events() if event.self_cpu_memory_usage > 0]
+    return sum(sizes) / 2 ** 20, len(sizes)
+
+
+def timed(fn, repeat):
+    """Median wall time of fn() over repeat runs."""
+    times = []
+    for _ in range(repeat):
+        sync()
+        start = time.perf_counter()
+        fn()
+        sync()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def write_tokenizer(path):
+    """A byte level BPE with GPT-2's vocabulary size: the 256 byte symbols, merges of pairs of them and <|endoftext|>."""
+    symbols = list(bytes_to_unicode().values())
+    vocab = {s: i for i, s in enumerate(symbols)}
+    merges = []
+    for a in symbols:
+        for b in symbols:
+            if len(vocab) == VOCAB_SIZE - 1:
+                break
+            merges.append(a + ' ' + b)
+            vocab[a + b] = len(vocab)
+    vocab["<|endoftext|>"] = len(vocab)
+    with open(Path(path, 'vocab.json'), 'w', encoding='utf-8') as f:
+        json.dump(vocab, f)
+    with open(Path(path, 'merges.txt'), 'w', encoding='utf-8') as f:
+        f.write('#version: 0.2\n' + '\n'.join(merges) + '\n')
+
+
+def write_models(root):
+    """Saves tiny random GPT-2 and GPT-Neo checkpoints under root, returns {kind: path}."""
+    torch.manual_seed(0)
+    paths = {"gpt2": Path(root, "tiny-gpt2"), "gpt-neo": Path(root, "tiny-gpt-neo")}
+    GPT2LMHeadModel(GPT2Config(vocab_size=VOCAB_SIZE, n_positions=1024, n_ctx=1024, n_embd=128, n_layer=4,
+                               n_head=4)).save_pretrained(str(paths["gpt2"]))
+    GPTNeoForCausalLM(GPTNeoConfig(vocab_size=VOCAB_SIZE, max_position_embeddings=2048, hidden_size=128, num_layers=4,
+                                   num_heads=4, attention_types=[[["global", "local"], 2]], window_size=256,
+                                   intermediate_size=512)).save_pretrained(str(paths["gpt-neo"]))
+    for path in paths.values():
+        write_tokenizer(path)
+    paths["gpt2-experimental"] = paths["gpt2"]
+    return paths
+
+
+def load_generator(kind, path):
+    settings['gpt2-experimental'] = 'on' if kind == 'gpt2-experimental' else 'off'
+    return GPT2Generator(model_path=path, generate_num=60)
+
+
+def bench_model(kind, path, args, results):
+    generator = load_generator(kind, path)
+    max_context = generator.max_history_tokens
+    context_lengths = [n for n in (32, 256, 960) if n <= max_context]
+    generate_nums = (20,) if args.quick else (20, 60)
+    rng = random.Random(0)
+
+    def tokens(n):
+        return [rng.randrange(VOCAB_SIZE - 1) for _ in range(n)]
+
+    def generate_raw(context, generate_num, sampler):
+        generator.clear_past()  # cold: no cache to reuse
+        generator.generate_raw(context_tokens=context, generate_num=generate_num, **sampler)
+
+    sampler = SAMPLERS["default"]
+    for n in context_lengths:
+        context = tokens(n)
+        input_ids = torch.tensor([context], device=generator.device)
+
+        def prefill():
+            with torch.no_grad():
+                generator.model(input_ids=input_ids, return_dict=True)
+
+        prefill_s = timed(prefill, args.repeat)
+        ttft_s = timed(lambda: generate_raw(context, 1, sampler), args.repeat)
+        results["{}/prefill/ctx={}".format(kind, n)] = {"seconds": prefill_s, "tok_s": n / prefill_s}
+        results["{}/ttft/ctx={}".format(kind, n)] = {"seconds": ttft_s, "rss_mb": rss_mb()}
+        for generate_num in generate_nums:
+            seconds = timed(lambda: generate_raw(context, generate_num, sampler), args.repeat)
+            results["{}/generate_raw/ctx={}/gen={}".format(kind, n, generate_num)] = {
+                "seconds": seconds,
+                "tok_s": generate_num / seconds,
+                "decode_tok_s": (generate_num - 1) / max(seconds - ttft_s, 1e-9),
+                "rss_mb": rss_mb(),
+            }
+
+    context = tokens(context_lengths[-1])
+    for name, sampler in SAMPLERS.items():
+        seconds = timed(lambda: generate_raw(context, generate_nums[0], sampler), args.repeat)
+        results["{}/sampler={}/ctx={}/gen={}".format(kind, name, len(context), generate_nums[0])] = {
+            "seconds": seconds, "tok_s": generate_nums[0] / seconds}
+
+    # generate retries when the result is empty after formatting, which random weights make common
+    calls = []
+    generate_raw_once = generator.generate_raw
+
+    def counting_generate_raw(*a, **kw):
+        calls.append(1)
+        return generate_raw_once(*a, **kw)
+
+    generator.generate_raw = counting_generate_raw
+    prompt = story_text(400)
+    generator.clear_past()
+    torch.manual_seed(0)
+    seconds = timed(lambda: generator.generate(context=prompt, **SAMPLERS["default"]), args.repeat)
+    results["{}/generate/words=400".format(kind)] = {"seconds": seconds, "generate_raw_calls": len(calls) / args.repeat}
+
+    # a few turns of a story, which reuse the previous turn's cache
+    settings['temp'], settings['top-keks'], settings['top-p'], settings['rep-pen'] = '0.6', '40', '0.9', '1.25'
+    del calls[:]
+    generator.clear_past()
+    torch.manual_seed(0)
+    story = Story(generator, story_text(200, seed=1))
+    turns = 2 if args.quick else 5
+    start = time.perf_counter()
+    story.act(story_text(20, seed=2))
+    for turn in range(turns - 1):
+        story.act("You " + story_text(8, seed=3 + turn).lower())
+    seconds = (time.perf_counter() - start) / turns
+    generator.generate_raw = generate_raw_once
+    results["{}/story_act/turns={}".format(kind, turns)] = {"seconds": seconds,
+                                                            "generate_raw_calls": len(calls) / turns,
+                                                            "rss_mb": rss_mb()}
+    return generator
+
+
+def bench_static_cache(path, args, results):
+    """
+    Decoding with the experimental GPT-2's static cache, and growing the cache every step instead. The prefill is
+    the same either way and would hide the difference, so it's reported apart: generating a single token is the
+    prefill, and what generating more costs on top of it is divided by the decode steps it took.
+    """
+    settings['gpt2-experimental'] = 'on'
+    generator = GPT2Generator(model_path=path, generate_num=60)
+    rng = random.Random(0)
+    context = [rng.randrange(VOCAB_SIZE - 1) for _ in range(min(960, generator.max_history_tokens))]
+    generate_num = 20 if args.quick else 60
+
+    def generate_raw(n):
+        generator.clear_past()
+        torch.manual_seed(0)  # the same tokens either way
+        generator.generate_raw(context_tokens=context, generate_num=n, **SAMPLERS["default"])
+
+    def decode_steps(n):
+        tracer.reset()
+        tracer.enabled = True
+        try:
+            generate_raw(n)
+        finally:
+            tracer.enabled = False
+        return tracer.counters.get("decode steps", 0)
+
+    for static in (True, False):
+        generator.model.enable_static_cache(static)
+        steps = max(decode_steps(generate_num) - decode_steps(1), 1)
+        prefill_s = timed(lambda: generate_raw(1), args.repeat)
+        seconds = timed(lambda: generate_raw(generate_num), args.repeat)
+        prefill_mb, prefill_allocs = allocations(lambda: generate_raw(1))
+        alloc_mb, allocs = allocations(lambda: generate_raw(generate_num))
+        name = "gpt2-experimental/static-cache={}/ctx={}".format("on" if static else "off", len(context))
+        results[name + "/prefill"] = {"seconds": prefill_s, "alloc_mb": prefill_mb, "allocations": prefill_allocs}
+        results[name + "/decode-per-token"] = {"seconds": (seconds - prefill_s) / steps,
+                                               "alloc_mb": (alloc_mb - prefill_mb) / steps,
+                                               "allocations": (allocs - prefill_allocs) / steps}
+
+
+def bench_text(tokenizer, args, results):
+    prompt = story_text(60, seed=10)
+    for n_words in (200, 2000, 20000):
+        context = story_text(n_words, seed=11)
+        seconds = timed(lambda: memory_merge(prompt, context, tokenizer, 1024 - 60), args.repeat)
+        results["memory_merge/words={}".format(n_words)] = {"seconds": seconds}
+    for n_chars in (200, 13000):
+        text = dialogue_text(n_chars, seed=12)
+        for fn in (first_to_second_person, second_to_first_person):
+            seconds = timed(lambda: fn(text), args.repeat * 5)
+            results["{}/dialogue/chars={}".format(fn.__name__, n_chars)] = {"seconds": seconds}
+
+
+def bench_sampler(args, results):
+    torch.manual_seed(0)
+    logits = torch.randn(VOCAB_SIZE) * 3
+    repeat = args.repeat * 20
+    for top_k, top_p in ((40, 0.0), (0, 0.9), (40, 0.9)):
+        name = "k={}/p={}".format(top_k, top_p)
+        seconds = timed(lambda: top_k_top_p_filtering(logits.clone(), top_k=top_k, top_p=top_p), repeat)
+        results["top_k_top_p_filtering/" + name] = {"seconds": seconds}
+        seconds = timed(lambda: top_k_top_p_candidates(logits, top_k=top_k, top_p=top_p), repeat)
+        results["top_k_top_p_candidates/" + name] = {"seconds": seconds}
+
+
+def stateless_repetition_penalty(logits, generated, repetition_penalty, repetition_penalty_range, penalty):
+    """What every step did before RepetitionPenalty kept its state: gather/scatter over the whole window."""
+    if penalty is not None:
+        penalty_context = generated[..., -repetition_penalty_range:]
+        score = torch.gather(logits, -1, penalty_context)
+        penalty_window = penalty.type(score.dtype).to(score.device)[-penalty_context.size(-1):]
+        score = torch.where(score < 0, score * penalty_window, score / penalty_window)
+        logits.scatter_(-1, penalty_context, score)
+    else:
+        score = torch.gather(logits, -1, generated)
+        score = torch.where(score < 0, score * repetition_penalty, score / repetition_penalty)
+        logits.scatter_(-1, generated, score)
+    return logits
+
+
+def bench_repetition_penalty(args, results):
+    """Seconds per decode step of the penalty with the default range, against recomputing it from the tokens."""
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    steps = 64 * args.repeat
+    for batch in (1, 4):
+        torch.manual_seed(0)
+        tokens = torch.randint(0, VOCAB_SIZE, (batch, 1024 + steps), device=device)
+        logits = torch.randn(batch, VOCAB_SIZE, device=device) * 3
+        curve = repetition_penalty_curve(1.25, 512, 3.33)
+
+        def stateless():
+            for i in range(1024, 1024 + steps):
+                stateless_repetition_penalty(logits.clone(), tokens[:, :i], 1.25, 512, curve)
+
+        penalty = RepetitionPenalty(tokens[:, :1024], VOCAB_SIZE, 1.25, 512, 3.33)
+
+        def stateful():
+            for i in range(1024, 1024 + steps):
+                penalty(logits.clone())
+                penalty.add(tokens[:, i])
+
+        for name, fn in (("stateless", stateless), ("RepetitionPenalty", stateful)):
+            results["repetition_penalty/{}/batch={}".format(name, batch)] = {"seconds": timed(fn, args.repeat) / steps}
+
+
+def check(checks, name, diff, tolerance):
+    checks[name] = {"ok": bool(diff <= tolerance), "max_abs_diff": float(diff)}
+
+
+def check_scripts(checks):
+    """Runs the standalone checks, each exits with 1 if an optimized code path differs from its reference."""
+    for script in TEST_SCRIPTS:
+        failed = subprocess.run([sys.executable, script]).returncode != 0
+        check(checks, script, float("inf") if failed else 0.0, 0.0)
+
+
+def check_repetition_penalty(checks):
+    """RepetitionPenalty penalises every token in range once, with the factor of its most recent occurrence."""
+    torch.manual_seed(0)
+    worst = 0.0
+    for trial in range(50):
+        penalty_range = (512, 64, 0)[trial % 3]
+        generated = torch.randint(0, 300 if trial % 2 else VOCAB_SIZE, (int(torch.randint(6, 700, ())),))
+        logits = torch.randn(VOCAB_SIZE) * 3
+        context, added = generated[:-5], generated[-5:]
+        penalty = RepetitionPenalty(context, VOCAB_SIZE, 1.25, penalty_range, 3.33)
+        for token in added:
+            penalty.add(token.view(1))
+        result = penalty(logits.clone())
+
+        expected = logits.clone()
+        curve = repetition_penalty_curve(1.25, penalty_range, 3.33)
+        window = generated[-penalty_range:] if curve is not None else generated
+        last = {token: i for i, token in enumerate(window.tolist())}
+        for token, i in last.items():
+            factor = curve[len(curve) - len(window) + i].item() if curve is not None else 1.25
+            score = logits[token].item()
+            expected[token] = score * factor if score < 0 else score / factor
+        worst = max(worst, (result - expected).abs().max().item())
+    check(checks, "repetition_penalty_matches_reference", worst, 1e-5)
+
+
+def check_experimental(path, checks):
+    """The experimental GPT-2 gives the transformers GPT-2's logits, with and without its caches and backends."""
+    torch.manual_seed(0)
+    reference = GPT2LMHeadModel.from_pretrained(str(path)).eval()
+    experimental = gpt2.GPT2LMHeadModelExperimental.from_pretrained(str(path)).eval()
+    input_ids = torch.randint(0, VOCAB_SIZE, (2, 40))
+    backends = ["manual"] + (["sdpa"] if gpt2.HAS_SDPA else [])
+    with torch.no_grad():
+        expected = reference(input_ids=input_ids, return_dict=True).logits
+        for backend in backends:
+            experimental.set_attention_backend(backend)
+            for static in (False, True):
+                experimental.enable_static_cache(static)
+                out = experimental(input_ids=input_ids[:, :30], use_cache=True, return_dict=True)
+                logits, past = [out.logits], out.past_key_values
+                for i in range(30, 40):
+                    out = experimental(input_ids=input_ids[:, i:i + 1], past_key_values=past, use_cache=True,
+                                       return_dict=True)
+                    logits.append(out.logits)
+                    past = out.past_key_values
+                diff = (torch.cat(logits, 1) - expected).abs().max().item()
+                check(checks, "experimental_matches_gpt2/{}/static={}".format(backend, static), diff, 1e-3)
+
+            # left padded rows give the same logits as the row alone
+            experimental.enable_static_cache(False)
+            attention_mask = torch.ones_like(input_ids)
+            attention_mask[1, :10] = 0
+            padded = experimental(input_ids=input_ids, attention_mask=attention_mask, return_dict=True).logits
+            alone = reference(input_ids=input_ids[1:, 10:], return_dict=True).logits
+            check(checks, "experimental_padding/{}".format(backend), (padded[1, 10:] - alone[0]).abs().max().item(),
+                  1e-3)
+
+
+def compare(results, baseline):
+    """Prints the change of every metric present in both runs. Seconds and allocations should go down, the rest up."""
+    print("\nChange against the baseline:")
+    for name, metrics in results.items():
+        if name not in baseline:
+            continue
+        changes = []
+        for metric, value in metrics.items():
+            old = baseline[name].get(metric)
+            if not isinstance(value, (int, float)) or not old or metric in ("rss_mb", "generate_raw_calls"):
+                continue
+            speedup = old / value if metric in ("seconds", "alloc_mb", "allocations") else value / old
+            changes.append("{} {:.2f}x".format(metric, speedup))
+        if changes:
+            print("  {:55} {}".format(name, "  ".join(changes)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks generation on tiny random-weight models.")
+    parser.add_argument("--quick", action="store_true", help="fewer cases and repeats")
+    parser.add_argument("--models", default=",".join(MODELS), help="which of {} to run".format(", ".join(MODELS)))
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--baseline", help="results of an earlier run to compare with")
+    args = parser.parse_args()
+    args.repeat = 1 if args.quick else 3
+
+    results, checks = {}, {}
+    root = tempfile.mkdtemp(prefix="clover-benchmark-")
+    try:
+        paths = write_models(root)
+        generator = None
+        for kind in args.models.split(","):
+            print("benchmarking " + kind, flush=True)
+            generator = bench_model(kind, paths[kind], args, results)
+        if "gpt2-experimental" in args.models.split(","):
+            print("benchmarking the static cache", flush=True)
+            bench_static_cache(paths["gpt2-experimental"], args, results)
+        tokenizer = generator.tokenizer if generator else GPT2Generator(model_path=paths["gpt2"]).tokenizer
+        bench_text(tokenizer, args, results)
+        bench_sampler(args, results)
+        bench_repetition_penalty(args, results)
+        check_scripts(checks)
+        check_repetition_penalty(checks)
+        check_experimental(paths["gpt2"], checks)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "device": "cuda" if DTYPE == torch.float16 else "cpu",
+            "dtype": str(DTYPE),
+            "torch": torch.__version__,
+            "threads": torch.get_num_threads(),
+            "quick": args.quick,
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        },
+        "peak_rss_mb": peak_rss_mb(),
+        "results": {name: {k: round(v, 6) if isinstance(v, float) else v for k, v in metrics.items()}
+                    for name, metrics in results.items()},
+        "checks": checks,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    for name, metrics in report["results"].items():
+        print("{:55} {}".format(name, "  ".join("{}={}".format(k, v) for k, v in metrics.items())))
+    for name, result in checks.items():
+        print("{:55} {} (max diff {:.2e})".format(name, "ok" if result["ok"] else "FAILED", result["max_abs_diff"]))
+    print("peak rss: {} MB, results written to {}".format(report["peak_rss_mb"], args.output))
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(report["results"], json.load(f)["results"])
+    return all(result["ok"] for result in checks.values())
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main() else 1)
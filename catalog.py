@@ -0,0 +1,139 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+from getconfig import logger
+from journal import SaveJournal
+
+# how much of a story's context is kept to tell saves apart in the menu
+SNIPPET_LENGTH = 160
+
+
+def save_stat(path):
+    """Modified time and size of the save at path, counting its journal in."""
+    stat = path.stat()
+    mtime, size = stat.st_mtime, stat.st_size
+    try:
+        journal_stat = path.with_suffix('.journal').stat()
+        mtime, size = max(mtime, journal_stat.st_mtime), size + journal_stat.st_size
+    except OSError:
+        pass
+    return mtime, size
+
+
+def save_files(root):
+    """Yields the path of every save under root."""
+    for entry in os.scandir(str(root)):
+        if entry.is_dir():
+            yield from save_files(entry.path)
+        elif entry.name.endswith('.json'):
+            yield Path(entry.path)
+
+
+class SaveCatalog:
+    """
+    An index of the saves folder in a sqlite database inside it, so the load menu can list, page through and
+    filter tens of thousands of saves without opening them. update() keeps it current after each save, and
+    refresh() catches up with saves added, changed or removed outside of the game, by their modified time.
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.path = self.root / '.catalog.db'
+        self.refreshed = threading.Event()
+        self.thread = None
+
+    @contextmanager
+    def connect(self):
+        os.makedirs(str(self.root), exist_ok=True)
+        db = sqlite3.connect(str(self.path), timeout=30)
+        try:
+            with db:
+                db.execute("CREATE TABLE IF NOT EXISTS saves (path TEXT PRIMARY KEY, mtime REAL, size INTEGER,"
+                           " turns INTEGER, snippet TEXT)")
+                db.execute("CREATE INDEX IF NOT EXISTS saves_mtime ON saves (mtime)")
+                yield db
+        finally:
+            db.close()
+
+    def key(self, path):
+        return Path(path).relative_to(self.root).as_posix()
+
+    def row(self, path, state):
+        mtime, size = save_stat(path)
+        if not isinstance(state, dict):
+            return self.key(path), mtime, size, None, ""
+        snippet = ' '.join((state.get("context") or ' '.join(state.get("actions", [])[:1])).split())
+        return self.key(path), mtime, size, len(state.get("actions", [])), snippet[:SNIPPET_LENGTH]
+
+    def update(self, path, state):
+        """Records the save at path, which now holds state (a Story.to_dict())."""
+        try:
+            with self.connect() as db:
+                db.execute("INSERT OR REPLACE INTO saves VALUES (?, ?, ?, ?, ?)", self.row(Path(path), state))
+        except (OSError, sqlite3.Error) as e:
+            logger.warning("Could not update the saves catalog: %s", e)
+
+    def read_row(self, path):
+        try:
+            state = SaveJournal(path).load()
+        except (OSError, ValueError) as e:
+            logger.warning("Could not read %s for the saves catalog: %s", path, e)
+            state = None
+        return self.row(path, state)
+
+    def add_missing(self):
+        """Adds the saves that aren't in the catalog at all, without looking at the ones that changed."""
+        try:
+            with self.connect() as db:
+                known = {path for path, in db.execute("SELECT path FROM saves")}
+            rows = [self.read_row(path) for path in save_files(self.root) if self.key(path) not in known]
+            if rows:
+                with self.connect() as db:
+                    db.executemany("INSERT OR REPLACE INTO saves VALUES (?, ?, ?, ?, ?)", rows)
+        except (OSError, sqlite3.Error) as e:
+            logger.warning("Could not update the saves catalog: %s", e)
+
+    def refresh(self):
+        """Indexes the saves that changed since they were last indexed and forgets the ones that are gone."""
+        try:
+            with self.connect() as db:
+                known = {path: mtime for path, mtime in db.execute("SELECT path, mtime FROM saves")}
+            found, rows = set(), []
+            for path in save_files(self.root):
+                key = self.key(path)
+                found.add(key)
+                if known.get(key) == save_stat(path)[0]:
+                    continue
+                rows.append(self.read_row(path))
+            with self.connect() as db:
+                db.executemany("INSERT OR REPLACE INTO saves VALUES (?, ?, ?, ?, ?)", rows)
+                db.executemany("DELETE FROM saves WHERE path = ?", [(key,) for key in known if key not in found])
+        except (OSError, sqlite3.Error) as e:
+            logger.warning("Could not update the saves catalog: %s", e)
+        finally:
+            self.refreshed.set()
+
+    def refresh_in_background(self):
+        self.thread = threading.Thread(target=self.refresh, name="save-catalog", daemon=True)
+        self.thread.start()
+
+    def search(self, text="", offset=0, limit=20):
+        """
+        Saves whose name or snippet contains text, newest first, as (path, mtime, size, turns, snippet) rows,
+        and how many there are in all.
+        """
+        if self.thread is None and not self.refreshed.is_set():
+            self.refresh()
+        elif not self.refreshed.is_set():
+            # the rows already there are listed as they are, the refresh updates them when it's done
+            self.add_missing()
+        pattern = '%' + text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        where = "WHERE path LIKE ? ESCAPE '\\' OR snippet LIKE ? ESCAPE '\\'"
+        with self.connect() as db:
+            total = db.execute("SELECT COUNT(*) FROM saves " + where, (pattern, pattern)).fetchone()[0]
+            rows = db.execute("SELECT * FROM saves " + where + " ORDER BY mtime DESC LIMIT ? OFFSET ?",
+                              (pattern, pattern, limit, offset)).fetchall()
+        return [(self.root / path, mtime, size, turns, snippet) for path, mtime, size, turns, snippet in rows], total
@@ -0,0 +1,145 @@
+import inspect
+import itertools
+import json
+import os
+from contextlib import contextmanager
+from pathlib import Path
+
+import torch
+from getconfig import logger
+
+try:
+    import safetensors.torch
+except ImportError:
+    safetensors = None
+
+# loading into a model whose parameters are on the meta device needs load_state_dict(assign=True), torch 2.1 or newer
+CAN_ASSIGN = 'assign' in inspect.signature(torch.nn.Module.load_state_dict).parameters
+# files this module and quantize.py keep in a model's folder, they're not part of the checkpoint
+CACHE_PREFIXES = ("converted-", "quantized-")
+
+
+def fingerprint(checkpoint_path, model_class):
+    """What a cached conversion depends on: the checkpoint's weight files, the model class and the torch version."""
+    files = sorted(p for p in Path(checkpoint_path).iterdir()
+                   if p.suffix in ('.bin', '.pt', '.safetensors', '.json') and not p.name.startswith(CACHE_PREFIXES))
+    return {
+        "files": [[p.name, p.stat().st_size, p.stat().st_mtime_ns] for p in files],
+        "model_class": model_class.__name__,
+        "torch": torch.__version__,
+    }
+
+
+def is_cached(path, expected):
+    info_path = path.with_suffix('.json')
+    if not path.exists() or not info_path.exists():
+        return False
+    try:
+        with info_path.open() as f:
+            return json.load(f) == expected
+    except (OSError, ValueError):
+        return False
+
+
+def write_cached(path, expected, save):
+    """Calls save(tmp_path) and moves the result to path, then records what it was made from."""
+    tmp_path = path.with_suffix('.tmp')
+    try:
+        save(tmp_path)
+        os.replace(str(tmp_path), str(path))
+        with path.with_suffix('.json').open('w') as f:
+            json.dump(expected, f)
+    except OSError as e:
+        logger.warning("Could not write %s: %s", path, e)
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+
+def split_aliases(state_dict):
+    """Drops the tensors that share memory with another one (tied weights), returns them as {alias: name}."""
+    tensors, aliases, seen = {}, {}, {}
+    for name, tensor in state_dict.items():
+        key = (tensor.data_ptr(), tensor.shape, tensor.dtype)
+        if tensor.numel() and key in seen:
+            aliases[name] = seen[key]
+        else:
+            seen[key] = name
+            tensors[name] = tensor.contiguous()
+    return tensors, aliases
+
+
+def save_converted(model, path):
+    tensors, aliases = split_aliases(model.state_dict())
+    if safetensors is not None:
+        safetensors.torch.save_file(tensors, str(path), metadata={"aliases": json.dumps(aliases)})
+    else:
+        torch.save({"tensors": tensors, "aliases": aliases}, str(path))
+
+
+def read_converted(path, device):
+    """Maps the converted weights, without reading them in full or converting them."""
+    if safetensors is not None:
+        with safetensors.safe_open(str(path), framework="pt") as f:
+            aliases = json.loads(f.metadata()["aliases"])
+        tensors = safetensors.torch.load_file(str(path), device=str(device))
+    else:
+        data = torch.load(str(path), map_location=device, mmap=True, weights_only=True)
+        tensors, aliases = data["tensors"], data["aliases"]
+    for alias, name in aliases.items():
+        tensors[alias] = tensors[name]
+    return tensors
+
+
+@contextmanager
+def parameters_on_meta():
+    """
+    Modules built inside get their parameters on the meta device, where they take no memory and aren't initialized.
+    Buffers are left alone: the ones that aren't saved with the weights, like GPT-2's causal masks, are only ever
+    made by the constructors.
+    """
+    register_parameter = torch.nn.Module.register_parameter
+
+    def register_on_meta(module, name, param):
+        if param is not None and not param.is_meta:
+            param = torch.nn.Parameter(param.to('meta'), requires_grad=param.requires_grad)
+        register_parameter(module, name, param)
+
+    torch.nn.Module.register_parameter = register_on_meta
+    try:
+        yield
+    finally:
+        torch.nn.Module.register_parameter = register_parameter
+
+
+def load_converted(model_class, checkpoint_path, dtype, device):
+    """
+    Loads checkpoint_path in dtype on device. The first load converts the checkpoint to dtype and stores it next to
+    it (as safetensors when installed), later loads map that file into a model whose parameters were never
+    allocated, so the full 32 bit copy from_pretrained makes is skipped.
+    Falls back to from_pretrained when the checkpoint isn't a folder or torch is too old.
+    """
+    checkpoint_path = Path(checkpoint_path)
+    if not checkpoint_path.is_dir() or not CAN_ASSIGN:
+        return model_class.from_pretrained(str(checkpoint_path)).to(dtype).to(device)
+
+    suffix = '.safetensors' if safetensors is not None else '.pt'
+    path = checkpoint_path / "converted-{}-{}{}".format(model_class.__name__, str(dtype).replace('torch.', ''), suffix)
+    expected = fingerprint(checkpoint_path, model_class)
+    if is_cached(path, expected):
+        try:
+            config = model_class.config_class.from_pretrained(str(checkpoint_path))
+            with parameters_on_meta():
+                model = model_class(config)
+            model.load_state_dict(read_converted(path, device), assign=True)
+            if not any(t.is_meta for t in itertools.chain(model.parameters(), model.buffers())):
+                logger.info("Loaded %s", path)
+                # the buffers the constructors made are still 32 bit and on the cpu
+                return model.to(dtype).to(device)
+            logger.warning("%s is missing some of the model's tensors, converting the model again", path)
+        except Exception as e:
+            logger.warning("Could not load %s, converting the model again: %s", path, e)
+
+    logger.info("Converting %s to %s for faster loading, this only happens once", checkpoint_path, dtype)
+    model = model_class.from_pretrained(str(checkpoint_path)).to(dtype)
+    write_cached(path, expected, lambda tmp_path: save_converted(model, tmp_path))
+    return model.to(device)
@@ -3,7 +3,11 @@ import math
 import torch
 from transformers import GPT2Config
 from transformers import GPT2PreTrainedModel
+from transformers.modeling_outputs import CausalLMOutputWithPast
 
+# fused attention, new in torch 2.0
+HAS_SDPA = hasattr(torch.nn.functional, 'scaled_dot_product_attention')
+ATTENTION_BACKENDS = ("auto", "sdpa", "manual")
 
 
 def gelu(x):
@@ -18,9 +22,9 @@ class Conv1D(torch.nn.Module):
         """
         super(Conv1D, self).__init__()
         self.nf = nf
-        w = torch.empty(nx, nf)
-        torch.nn.init.normal_(w, std=0.02)
-        self.weight = torch.nn.Parameter(w)
+        # registered before it's initialized, so fastload can build the model without initializing the weights
+        self.weight = torch.nn.Parameter(torch.empty(nx, nf))
+        torch.nn.init.normal_(self.weight, std=0.02)
         self._weightT = None
         self.bias = torch.nn.Parameter(torch.zeros(nf))
 
@@ -30,6 +34,37 @@ class Conv1D(torch.nn.Module):
         return torch.nn.functional.linear(x, self._weightT, self.bias)
 
 
+class StaticCache:
+    """ Preallocated key/value cache of shape [layers, 2, batch, heads, max_length, head_dim], max_length being n_ctx
+        unless given. New keys and values are written in place and attention reads a view of the filled part,
+        so a decoding step doesn't copy the whole cache. length is the number of filled positions.
+    """
+
+    def __init__(self, config, dtype, device, batch_size=1, max_length=None):
+        self.config = config
+        head_dim = config.n_embd // config.n_head
+        max_length = max_length if max_length is not None else config.n_ctx
+        self.buffer = torch.empty((config.n_layer, 2, batch_size, config.n_head, max_length, head_dim),
+                                  dtype=dtype, device=device)
+        self.length = 0
+
+    @property
+    def batch_size(self):
+        return self.buffer.size(2)
+
+    def crop(self, length):
+        """ Forget everything after the first length positions, they'll be overwritten """
+        self.length = length
+        return self
+
+    def expand(self, batch_size, max_length=None):
+        """ A new cache with the filled part of this batch-size-1 cache copied into every row """
+        cache = StaticCache(self.config, self.buffer.dtype, self.buffer.device, batch_size, max_length)
+        cache.buffer[..., :self.length, :] = self.buffer[..., :self.length, :]
+        cache.length = self.length
+        return cache
+
+
 class Attention(torch.nn.Module):
     def __init__(self, n_embd, n_ctx, config):
         super(Attention, self).__init__()
@@ -39,11 +74,13 @@ class Attention(torch.nn.Module):
         self.register_buffer("m1e4", torch.full((1, 1, 1), -1e4))
         self.n_head = config.n_head
         self.n_embd = n_embd
+        self.use_sdpa = False
 
         self.c_attn = Conv1D(n_embd * 3, n_embd)
         self.c_proj = Conv1D(n_embd, n_embd)
 
     def _attn(self, q, k, v, mask):
+        """ k is transposed. mask is a boolean mask of the keys each query may attend to. """
         w = torch.matmul(q, k)
         w /= math.sqrt(v.size(-1))
 
@@ -52,34 +89,47 @@ class Attention(torch.nn.Module):
         return torch.matmul(w, v)
 
     def merge_heads(self, x: torch.Tensor):
-        x = x.permute(1, 0, 2).contiguous()
+        x = x.permute(0, 2, 1, 3).contiguous()
         new_x_shape = x.size()[:-2] + (self.n_embd,)
         return x.view(*new_x_shape)  # in Tensorflow implem: fct merge_states
 
     def split_heads(self, x):
         new_x_shape = x.size()[:-1] + (self.n_head, self.n_embd // self.n_head)
         x = x.view(*new_x_shape)  # in Tensorflow implem: fct split_states
-        return x.permute(1, 0, 2)  # (batch, head, seq_length, head_features)
+        return x.permute(0, 2, 1, 3)  # (batch, head, seq_length, head_features)
 
-    def forward(self, x, layer_past, mask):
+    def forward(self, x, layer_past, mask, cache_position=None, is_causal=False):
+        """ With cache_position, layer_past is this layer's slice of a StaticCache and the new keys and values are
+            written into it at cache_position, otherwise they're concatenated to layer_past (a (key, value) tuple)
+            and returned as present. is_causal (sdpa only) replaces mask when there's no past and no padding.
+        """
         x = self.c_attn(x)
-        x = x.view((x.size(0), 3, self.n_embd))
-        query, key, value = x[:, 0], x[:, 1], x[:, 2]
-        # query, key, value = x.split(self.n_embd, dim=2)
+        query, key, value = x.split(self.n_embd, dim=2)
         query = self.split_heads(query)
         key = self.split_heads(key)  # , k=True)
         value = self.split_heads(value)
 
-        if layer_past is not None:
-            past_value = layer_past[1]  # transpose back cf below
-            value = torch.cat((past_value, value), dim=-2)
-
-            past_key = layer_past[0]  # .transpose(-2, -1)
-            key = torch.cat((past_key, key), dim=-2)
+        if cache_position is not None:
+            total_len = cache_position + key.size(-2)
+            layer_past[0, :, :, cache_position:total_len] = key
+            layer_past[1, :, :, cache_position:total_len] = value
+            key = layer_past[0, :, :, :total_len]
+            value = layer_past[1, :, :, :total_len]
+            present = None
+        else:
+            if layer_past is not None:
+                past_key, past_value = layer_past
+                key = torch.cat((past_key, key), dim=-2)
+                value = torch.cat((past_value, value), dim=-2)
 
-        present = torch.stack([key, value])  # transpose to have same shapes for stacking
+            present = (key, value)
 
-        a = self._attn(query, key.transpose(-2, -1), value, mask)
+        if self.use_sdpa:
+            # mask is already additive here, or None when every key may be attended to, or for a causal prefill
+            a = torch.nn.functional.scaled_dot_product_attention(query, key, value, attn_mask=mask,
+                                                                 is_causal=is_causal)
+        else:
+            a = self._attn(query, key.transpose(-2, -1), value, mask)
         a = self.merge_heads(a)
         a = self.c_proj(a)
 
@@ -111,8 +161,8 @@ class Block(torch.nn.Module):
         self.ln_2 = torch.nn.LayerNorm(n_embd, eps=config.layer_norm_epsilon)
         self.mlp = MLP(4 * n_embd, config)
 
-    def forward(self, x, layer_past, mask):
-        a, present = self.attn(self.ln_1(x), layer_past, mask)
+    def forward(self, x, layer_past, mask, cache_position=None, is_causal=False):
+        a, present = self.attn(self.ln_1(x), layer_past, mask, cache_position, is_causal)
         x = x + a
         x += self.mlp(self.ln_2(x))  # residual
 
@@ -128,37 +178,81 @@ class GPT2Model(GPT2PreTrainedModel):
         self.wpe = torch.nn.Embedding(config.n_positions, config.n_embd)
         self.h = torch.nn.ModuleList([Block(config.n_ctx, config) for _ in range(config.n_layer)])
         self.ln_f = torch.nn.LayerNorm(config.n_embd, eps=config.layer_norm_epsilon)
-        self.register_buffer("bigmask", torch.tril(torch.ones((config.n_ctx, config.n_ctx), dtype=torch.uint8)))
+        self.register_buffer("bigmask", torch.tril(torch.ones((config.n_ctx, config.n_ctx), dtype=torch.bool)))
+        self.use_sdpa = False
         self.init_weights()
 
+    def set_attention_backend(self, backend="auto"):
+        """ "sdpa" uses torch's fused scaled_dot_product_attention, "manual" the matmul/softmax implementation and
+            "auto" picks sdpa when this torch has it.
+        """
+        if backend not in ATTENTION_BACKENDS:
+            raise ValueError("attention backend must be one of {}, got {}".format(ATTENTION_BACKENDS, backend))
+        if backend == "sdpa" and not HAS_SDPA:
+            raise ValueError("scaled_dot_product_attention needs torch 2.0 or newer")
+        self.use_sdpa = backend == "sdpa" or (backend == "auto" and HAS_SDPA)
+        for block in self.h:
+            block.attn.use_sdpa = self.use_sdpa
+
     def get_input_embeddings(self):
         return self.wte
 
     def set_input_embeddings(self, new_embeddings):
         self.wte = new_embeddings
 
-    def forward(self, input_ids: torch.Tensor, past: torch.Tensor):
+    def forward(self, input_ids: torch.Tensor, past=None, attention_mask=None, position_ids=None):
+        """ input_ids is [batch, seq]. past is None, the presents returned by a previous call (a (key, value) tuple
+            per layer) or a StaticCache, which is filled in place and returned instead of the presents.
+            Rows of different lengths are left padded: attention_mask [batch, past + seq] is 0 on the padding, which
+            is never attended to, and positions count only the real tokens of each row.
+        """
         if input_ids is None:
             raise ValueError("You have to specify either input_ids or inputs_embeds")
 
-        input_len = input_ids.size(0)
-        past_length = past.size(-2) if past is not None else 0
+        static = isinstance(past, StaticCache)
+        input_len = input_ids.size(-1)
+        if static:
+            past_length = past.length
+        else:
+            past_length = past[0][0].size(-2) if past is not None else 0
         total_len = input_len + past_length
-        position_embeds = self.wpe.weight.data[past_length:total_len]
+        if position_ids is None:
+            if attention_mask is not None:
+                position_ids = (attention_mask.long().cumsum(-1) - 1).clamp(min=0)[:, past_length:total_len]
+            else:
+                position_ids = torch.arange(past_length, total_len, device=input_ids.device)
 
         inputs_embeds = self.wte(input_ids)
-        hidden_states = inputs_embeds + position_embeds
-
-        mask = self.bigmask[None, past_length:total_len, :total_len]
+        hidden_states = inputs_embeds + self.wpe(position_ids)
+
+        mask = self.bigmask[None, None, past_length:total_len, :total_len]
+        if attention_mask is not None:
+            mask = mask & attention_mask[:, None, None, :total_len].bool()
+        is_causal = False
+        if self.use_sdpa:
+            # a boolean mask makes fully masked (padding) rows NaN, so mask with -1e4 like the manual path does
+            if attention_mask is None and (input_len == 1 or past_length == 0):
+                # a single query sees every key, and a prefill without a past is plain causal attention, which sdpa
+                # has fused kernels for
+                mask, is_causal = None, input_len > 1
+            else:
+                mask = torch.zeros(mask.shape, dtype=hidden_states.dtype, device=hidden_states.device) \
+                    .masked_fill(~mask, -1e4)
         presents = []
         for i in range(self.config.n_layer):
+            if static:
+                hidden_states, _ = self.h[i](hidden_states, past.buffer[i], mask, past_length, is_causal)
+                continue
             layer_past = past[i] if past is not None else None
             trans_block = self.h[i]
-            hidden_states, present = trans_block(hidden_states, layer_past, mask)
+            hidden_states, present = trans_block(hidden_states, layer_past, mask, is_causal=is_causal)
             presents.append(present)
 
         hidden_states = self.ln_f(hidden_states)
-        return hidden_states, torch.stack(presents)
+        if static:
+            past.length = total_len
+            return hidden_states, past
+        return hidden_states, tuple(presents)
 
 
 class GPT2LMHeadModelExperimental(GPT2PreTrainedModel):
@@ -170,6 +264,8 @@ class GPT2LMHeadModelExperimental(GPT2PreTrainedModel):
 
         self.init_weights()
         self.tie_weights()
+        self.static_cache = None
+        self.use_static_cache = False
 
     def tie_weights(self):
         """ Make sure we are sharing the input and output embeddings.
@@ -178,7 +274,45 @@ class GPT2LMHeadModelExperimental(GPT2PreTrainedModel):
         self._tie_or_clone_weights(self.lm_head,
                                    self.transformer.wte)
 
-    def forward(self, input_ids: torch.Tensor, **kwargs):
-        hidden_states, pasts = self.transformer(input_ids, **kwargs)
+    def enable_static_cache(self, enabled=True):
+        """ Decode into a preallocated StaticCache instead of growing the cache every step.
+            Only one cache is kept: a generation starting without a past reuses (and overwrites) it.
+        """
+        self.use_static_cache = enabled
+        if not enabled:
+            self.static_cache = None
+
+    def set_attention_backend(self, backend="auto"):
+        self.transformer.set_attention_backend(backend)
+
+    def get_static_cache(self, batch_size=1):
+        weight = self.transformer.wte.weight
+        if self.static_cache is None or self.static_cache.buffer.dtype != weight.dtype \
+                or self.static_cache.buffer.device != weight.device or self.static_cache.batch_size != batch_size:
+            self.static_cache = None  # free the old one first
+            self.static_cache = StaticCache(self.config, weight.dtype, weight.device, batch_size)
+        return self.static_cache.crop(0)
+
+    def prepare_inputs_for_generation(self, input_ids, past=None, attention_mask=None, **kwargs):
+        if past is not None:
+            input_ids = input_ids[:, -1:]
+        return {"input_ids": input_ids, "past_key_values": past, "attention_mask": attention_mask}
+
+    def forward(self, input_ids: torch.Tensor, past=None, past_key_values=None, attention_mask=None,
+                position_ids=None, return_dict=False, **kwargs):
+        """ Accepts the transformers style arguments the samplers use. input_ids may also be a single unbatched
+            sequence, the logits are unbatched too then.
+        """
+        past = past if past is not None else past_key_values
+        unbatched = input_ids.dim() == 1
+        if unbatched:
+            input_ids = input_ids.unsqueeze(0)
+        if past is None and self.use_static_cache:
+            past = self.get_static_cache(input_ids.size(0))
+        hidden_states, pasts = self.transformer(input_ids, past, attention_mask, position_ids)
         lm_logits = self.lm_head(hidden_states)
+        if unbatched:
+            lm_logits = lm_logits[0]
+        if return_dict:
+            return CausalLMOutputWithPast(logits=lm_logits, past_key_values=pasts)
         return lm_logits, pasts
@@ -1,3 +1,4 @@
+import codecs
 import os
 from pathlib import Path
 from typing import Union
@@ -5,10 +6,12 @@ from typing import Union
 import torch
 import torch.nn.functional as F
 import re
-from gpt2 import GPT2LMHeadModelExperimental
-from transformers import GPT2Tokenizer, GPT2LMHeadModel, GPTNeoForCausalLM
+from gpt2 import GPT2LMHeadModelExperimental, StaticCache
+from fastload import fingerprint, load_converted
+from transformers import GPT2Tokenizer, GPT2LMHeadModel
 from getconfig import settings, logger
-from utils import cut_trailing_sentence, output, clear_lines, format_result, use_ptoolkit
+from profiler import startup, tracer
+from utils import cut_trailing_sentence, format_result, use_ptoolkit, OutcomeWatcher, StreamRenderer
 
 if not settings.getboolean('force-cpu') and not torch.cuda.is_available():
     logger.warning('CUDA is not available, you are limited to CPU only.')
@@ -18,6 +21,17 @@ logger.info('Cuda Available: {}    Force CPU: {}    Precision: {}'.format(torch.
                                                                           settings.getboolean('force-cpu'),
                                                                           '32-bit' if DTYPE == torch.float32 else '16-bit'))
 
+# How many of the most likely tokens the sampler filters before falling back to sorting the whole vocabulary
+MAX_CANDIDATES = 512
+# top_k_top_p_filtering sums the probabilities over the whole sorted vocabulary, in another order than the candidate
+# sampler, so their cumulative probabilities can differ by this much (float32 rounding) and cut in different places
+NUCLEUS_TOLERANCE = 1e-4
+
+# text with one of these in it survives result_replace, so generate can stop constraining the first tokens
+USABLE_TEXT = re.compile(r'[^\s#*>]')
+# cut_trailing_sentence keeps the text up to one of these, so a death or a victory is kept once one follows it
+SENTENCE_END = re.compile(r'[.!?]')
+
 # warnings.filterwarnings("ignore")
 MODEL_CLASSES = {
     "gpt2": (GPT2LMHeadModel, GPT2Tokenizer),
@@ -63,6 +77,187 @@ def memory_merge(prompt, context, tokenizer, maxHistory=1024):
     return context_tokens
 
 
+def memory_merge_chunks(prompt_tokens, chunks, maxHistory=1024):
+    """
+    memory_merge for a story that's already encoded in chunks. chunks yields token lists from the end of the story
+    backwards, and is only consumed until the window is full.
+    """
+    if len(prompt_tokens) >= maxHistory:
+        logger.debug("Clamping the amount of prompt tokens.")
+        return prompt_tokens[-maxHistory:]
+    budget = maxHistory - len(prompt_tokens)
+    tail = []
+    for tokens in chunks:
+        tail.append(tokens)
+        budget -= len(tokens)
+        if budget <= 0:
+            break
+    context_tokens = [t for tokens in reversed(tail) for t in tokens]
+    return prompt_tokens + context_tokens[-(maxHistory - len(prompt_tokens)):]
+
+
+def past_length(past):
+    """Number of positions held by a past_key_values structure (tuple of layers, a stacked tensor or a StaticCache)."""
+    if isinstance(past, StaticCache):
+        return past.length
+    while not torch.is_tensor(past):
+        past = past[0]
+    return past.size(-2)
+
+
+def crop_past(past, length):
+    """Cut a past_key_values structure down to its first `length` positions. All layouts keep the sequence on dim -2."""
+    if isinstance(past, StaticCache):
+        return past.crop(length)
+    if torch.is_tensor(past):
+        return past[..., :length, :]
+    return tuple(crop_past(p, length) for p in past)
+
+
+def common_prefix_length(a, b):
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+
+class StreamingDetokenizer:
+    """
+    Turns generated token ids into text one token at a time, instead of re-decoding the whole output every step.
+    Byte-level BPE tokens can end in the middle of a multi-byte UTF-8 character, so undecodable trailing bytes are
+    held back until the token completing them arrives. The finished text matches
+    tokenizer.decode(ids, skip_special_tokens=True, clean_up_tokenization_spaces=False).
+    """
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.byte_decoder = getattr(tokenizer, 'byte_decoder', None)
+        self.special_ids = set(tokenizer.all_special_ids)
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.ids = []
+        self.pieces = []
+        # how many pieces there were before each token was added
+        self.piece_counts = []
+        self._text = None
+
+    def add(self, token_id):
+        """Feed one token id, returns the newly completed text (possibly empty)."""
+        self.ids.append(token_id)
+        self.piece_counts.append(len(self.pieces))
+        if token_id in self.special_ids:
+            return ''
+        data = self.token_bytes(token_id)
+        if data is None:
+            # not a byte-level token (e.g. an added token), the tokenizer knows best
+            piece = self.decoder.decode(b'', final=True) + self.tokenizer.decode(
+                [token_id], clean_up_tokenization_spaces=False, skip_special_tokens=True)
+        else:
+            piece = self.decoder.decode(data)
+        if piece:
+            self.pieces.append(piece)
+            self._text = None
+        return piece
+
+    def finish(self):
+        """Flush any dangling partial character, the same way a full decode would replace it."""
+        piece = self.decoder.decode(b'', final=True)
+        if piece:
+            self.pieces.append(piece)
+            self._text = None
+        return piece
+
+    def token_bytes(self, token_id):
+        """The bytes of a byte-level token, None for the ones only the tokenizer can decode."""
+        token = self.tokenizer.convert_ids_to_tokens(token_id)
+        if self.byte_decoder is None or token is None or not all(c in self.byte_decoder for c in token):
+            return None
+        return bytes(self.byte_decoder[c] for c in token)
+
+    def truncate(self, n):
+        """
+        Forget everything after the first n tokens. A character left incomplete at the cut is held back again, so
+        finish() replaces it the way decoding the first n tokens would.
+        """
+        if n < len(self.ids):
+            del self.pieces[self.piece_counts[n]:]
+            del self.ids[n:], self.piece_counts[n:]
+            # what was held back at the cut is in the last bytes kept, a character has at most 4
+            tail = b''
+            for token_id in reversed(self.ids):
+                if len(tail) >= 4:
+                    break
+                if token_id in self.special_ids:
+                    continue
+                data = self.token_bytes(token_id)
+                if data is None:
+                    break  # nothing was held back past a token the tokenizer decoded
+                tail = data + tail
+            self.decoder.reset()
+            self.decoder.decode(tail)
+            self._text = None
+
+    @property
+    def text(self):
+        if self._text is None:
+            self._text = ''.join(self.pieces)
+        return self._text
+
+
+def empty_result_token_ids(tokenizer):
+    """
+    Ids of the tokens that make result_replace return nothing when the result starts with them: the special tokens
+    (<|endoftext|>), tokens holding a '>' (the start of an action), and tokens that are only whitespace or the '#' and
+    '*' result_replace removes.
+    """
+    banned = set(tokenizer.all_special_ids)
+    byte_decoder = getattr(tokenizer, 'byte_decoder', None)
+    for token, token_id in tokenizer.get_vocab().items():
+        if byte_decoder is not None and all(c in byte_decoder for c in token):
+            # partial characters decode to U+FFFD and are allowed
+            text = bytes(byte_decoder[c] for c in token).decode('utf-8', errors='replace')
+        else:
+            text = tokenizer.convert_tokens_to_string([token])
+        if '>' in text or not USABLE_TEXT.search(text):
+            banned.add(token_id)
+    return sorted(banned)
+
+
+class LoopDetector:
+    """
+    Notices the generation copying the recent story (or itself) word for word while it's being generated.
+    Every n-gram of the last `window` context tokens and of the generated tokens is kept in a set. A loop is evident
+    once the last loop_tokens generated tokens were all copied: every n-gram they complete was seen before.
+    """
+
+    def __init__(self, context_tokens, loop_tokens, n=4, window=512):
+        self.n = n
+        self.min_run = max(loop_tokens - n + 1, 1)
+        tail = list(context_tokens[-window:])
+        self.seen = {tuple(tail[i:i + n]) for i in range(len(tail) - n + 1)}
+        self.recent = tail[max(len(tail) - n + 1, 0):]
+        self.run = 0
+
+    def add(self, token):
+        """Adds a generated token, returns True once a loop is evident."""
+        self.recent.append(token)
+        if len(self.recent) < self.n:
+            return False
+        gram = tuple(self.recent)
+        del self.recent[0]
+        if gram in self.seen:
+            self.run += 1
+        else:
+            self.run = 0
+            self.seen.add(gram)
+        return self.run >= self.min_run
+
+    @property
+    def copied(self):
+        """How many of the last tokens are part of the copied run."""
+        return self.run + self.n - 1 if self.run else 0
+
+
 def top_k_top_p_filtering(logits, top_k=0, top_p=0.0, filter_value=-float("Inf")):
     """ Filter a distribution of logits using top-k and/or nucleus (top-p) filtering
         Args:
@@ -96,6 +291,173 @@ def top_k_top_p_filtering(logits, top_k=0, top_p=0.0, filter_value=-float("Inf")
     return logits
 
 
+def expand_past(past, batch_size, max_length=None):
+    """
+    Share a batch-size-1 past_key_values structure across batch_size rows without copying it.
+    A StaticCache is written in place, so it's copied into a new one with room for max_length positions instead.
+    """
+    if isinstance(past, StaticCache):
+        return past.expand(batch_size, max_length)
+    if torch.is_tensor(past):
+        return past.expand(batch_size, *past.shape[1:])
+    return tuple(expand_past(p, batch_size) for p in past)
+
+
+def repetition_penalty_curve(repetition_penalty, repetition_penalty_range, repetition_penalty_slope):
+    if repetition_penalty_range is None or repetition_penalty_slope is None or repetition_penalty_range <= 0:
+        return None
+    penalty = (torch.arange(repetition_penalty_range)/(repetition_penalty_range - 1)) * 2. - 1
+    penalty = (repetition_penalty_slope * penalty) / (1 + torch.abs(penalty) * (repetition_penalty_slope - 1))
+    penalty = 1 + ((penalty + 1) / 2) * (repetition_penalty - 1)
+    return penalty
+
+
+class RepetitionPenalty:
+    """
+    Repetition penalty from CTRL (https://arxiv.org/abs/1909.05858) plus range limit, for one sequence or a batch.
+    The state stays on the logits' device: per row, the position each token last occurred at, and the tokens in
+    range in a ring buffer. Adding a token is one scatter_ and one write, and each step looks the factors of the
+    tokens in range up on the penalty curve (built once) with a gather, then penalises them with one scatter_,
+    so there's no host work or transfer per step.
+    A token that occurs several times in range is penalised once, with the factor of its most recent occurrence.
+    Without a range (or slope) the flat repetition_penalty applies to every token in the history.
+    """
+
+    def __init__(self, context, vocab_size, repetition_penalty, repetition_penalty_range=512,
+                 repetition_penalty_slope=3.33):
+        self.repetition_penalty = repetition_penalty
+        self.curve = repetition_penalty_curve(repetition_penalty, repetition_penalty_range, repetition_penalty_slope)
+        self.range = repetition_penalty_range if self.curve is not None else None
+        self.vocab_size = vocab_size
+        self.length = context.size(-1)
+        context = context.reshape(-1, self.length)
+        device = context.device
+        start = max(self.length - self.range, 0) if self.range is not None else 0
+        # per row, the position of the most recent occurrence of every token, -1 if it didn't occur
+        self.last = torch.full((context.size(0), vocab_size), -1, dtype=torch.long, device=device)
+        index, positions = [], []
+        for row, tokens in enumerate(context[:, start:].tolist()):
+            last = dict(zip(tokens, range(start, self.length)))  # later occurrences overwrite earlier ones
+            index.extend(row * vocab_size + token for token in last)
+            positions.extend(last.values())
+        self.last.view(-1)[torch.tensor(index, dtype=torch.long, device=device)] = \
+            torch.tensor(positions, dtype=torch.long, device=device)
+        self.window = None
+        if self.curve is not None:
+            self.curve = self.curve.to(device=device, dtype=torch.float32)
+            # the token at position p is in slot p % range. The slots not filled yet repeat a token in range, which
+            # changes nothing since every occurrence of a token gets the factor of the most recent one
+            self.window = context[:, start:start + 1].repeat(1, self.range)
+            self.window[:, torch.arange(start, self.length, device=device) % self.range] = context[:, start:]
+
+    def add(self, tokens):
+        """Record the newly generated token of each row."""
+        tokens = tokens.view(-1, 1)
+        self.last.scatter_(1, tokens, self.length)
+        if self.window is not None:
+            self.window[:, self.length % self.range] = tokens[:, 0]
+        self.length += 1
+
+    def __call__(self, logits):
+        """Penalise logits in place."""
+        rows = logits.view(-1, self.vocab_size)
+        if self.window is None:
+            factor = self.repetition_penalty
+            rows.copy_(torch.where(self.last >= 0, torch.where(rows < 0, rows * factor, rows / factor), rows))
+        else:
+            factor = self.curve[self.last.gather(1, self.window) - (self.length - self.range)]
+            score = rows.gather(1, self.window)
+            rows.scatter_(1, self.window, torch.where(score < 0, score * factor, score / factor))
+        return logits
+
+
+def top_k_top_p_candidates(logits, top_k=0, top_p=0.0, max_candidates=MAX_CANDIDATES, filter_value=-float("Inf")):
+    """ Same filtering as top_k_top_p_filtering, but only over the highest max_candidates logits, so the vocabulary is
+        never fully sorted or written to.
+        Returns (candidate_logits, candidate_indices), with removed candidates set to filter_value, or None when the
+        kept tokens might not all be among the candidates (or nothing gets filtered). Use top_k_top_p_filtering then.
+    """
+    vocab_size = logits.size(-1)
+    top_k = min(top_k, vocab_size)
+    if top_k <= 0 and top_p <= 0.0:
+        return None
+    # one spare candidate past top_k to notice ties with the k-th logit
+    values, indices = torch.topk(logits, min(max(max_candidates, top_k + 1), vocab_size))
+    complete = values.size(-1) == vocab_size
+
+    if top_k > 0:
+        keep = values >= values[..., top_k - 1, None]
+        if not complete and keep[..., -1].any():
+            return None
+        complete = True
+        values = values.masked_fill(~keep, filter_value)
+
+    if top_p > 0.0:
+        if complete:
+            probs = F.softmax(values, dim=-1)
+        else:
+            # the probabilities are still relative to the whole vocabulary
+            probs = torch.gather(F.softmax(logits, dim=-1), -1, indices)
+        cumulative_probs = torch.cumsum(probs, dim=-1)
+        sorted_indices_to_remove = cumulative_probs > top_p
+        if not complete and not sorted_indices_to_remove[..., -1].all():
+            # the nucleus is bigger than the candidate set
+            return None
+        if ((cumulative_probs - top_p).abs() <= NUCLEUS_TOLERANCE).any():
+            # too close to call, top_k_top_p_filtering might cut on the other side of this token
+            return None
+        # Shift the indices to the right to keep also the first token above the threshold
+        sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[..., :-1].clone()
+        sorted_indices_to_remove[..., 0] = 0
+        cut = sorted_indices_to_remove[..., 1:] & ~sorted_indices_to_remove[..., :-1]
+        if (cut & (values[..., 1:] == values[..., :-1]) & torch.isfinite(values[..., 1:])).any():
+            # a tie across the cut, which tokens of it are kept depends on how torch.sort orders them
+            return None
+        values = values.masked_fill(sorted_indices_to_remove, filter_value)
+    return values, indices
+
+
+def sample_token(logits, temperature, top_k, top_p, penalty, top_p_first):
+    """
+    Pick the next token from the last position's logits, for a single sequence or for a batch.
+    Originally the order was Temperature, Repetition Penalty, then top-k/p. top_p_first filters the raw logits instead.
+    Temperature and the penalty act on each token separately, so the candidates can be picked before or after them.
+    """
+    candidates = None
+    if top_p_first:
+        with tracer.span("filter"):
+            candidates = top_k_top_p_candidates(logits, top_k=top_k, top_p=top_p)
+            if candidates is None:
+                logits = top_k_top_p_filtering(logits, top_k=top_k, top_p=top_p)
+
+    logits = logits / (temperature if temperature > 0 else 1.0)
+
+    if penalty is not None:
+        with tracer.span("penalty"):
+            penalty(logits)
+
+    with tracer.span("filter"):
+        if top_p_first:
+            if candidates is not None:
+                values, indices = candidates
+                logits = torch.gather(logits, -1, indices).masked_fill(values == -float("Inf"), -float("Inf"))
+        else:
+            candidates = top_k_top_p_candidates(logits, top_k=top_k, top_p=top_p)
+            if candidates is None:
+                logits = top_k_top_p_filtering(logits, top_k=top_k, top_p=top_p)
+            else:
+                logits, indices = candidates
+
+    with tracer.span("multinomial"):
+        if temperature == 0:  # greedy sampling:
+            next_token = torch.argmax(logits, dim=-1, keepdim=True)
+        else:
+            next_token = torch.multinomial(F.softmax(logits, dim=-1), num_samples=1)
+        if candidates is not None:
+            next_token = torch.gather(indices, -1, next_token)
+    return next_token
+
+
 # length should be max length, other settings should be removed, device should not be set
 # we could possibly optimize this by having larger batch sizes but it would likely double or more the memory requirements
 def sample_sequence(
@@ -110,25 +472,45 @@ def sample_sequence(
         repetition_penalty_slope=3.33,
         device="cpu",
         stop_tokens=None,
-        tokenizer=None
+        tokenizer=None,
+        past=None,
+        banned_start_tokens=None,
+        loop_tokens=0,
+        watch_outcome=False
 ):
-    """Actually generate the tokens"""
+    """Actually generate the tokens
+    past: optional past_key_values covering a prefix of context, only the remaining suffix gets prefilled.
+    banned_start_tokens: optional tensor of token ids that can't be sampled until the text has something usable in it.
+    loop_tokens: if > 0, generation stops once that many tokens in a row repeat the recent context or the output,
+    and the repeated tokens are dropped.
+    watch_outcome: if set, generation stops at the end of the sentence in which the player dies or wins.
+    The returned tensor carries the final past_key_values in its `pasts` attribute.
+    """
     logger.debug(
         'temp: {}    top_k: {}    top_p: {}    rep-pen: {}    rep-pen-range: {}    rep-pen-slope: {}'.format(temperature, top_k, top_p, repetition_penalty, repetition_penalty_range, repetition_penalty_slope))
     context_tokens = context
     context = torch.tensor(context, dtype=torch.long, device=device)
     # context = context.repeat(num_samples, 1)
-    generated = context
+    # generated is always a view of this buffer, so adding a token doesn't copy the whole sequence
+    tokens = torch.empty(len(context_tokens) + length, dtype=torch.long, device=device)
+    tokens[:len(context_tokens)] = context
+    generated = tokens[:len(context_tokens)]
     USE_PAST = True
     next_token = context
     pasts = None
-    clines = 0
+    renderer = StreamRenderer()
+    detokenizer = StreamingDetokenizer(tokenizer)
+    constrained = banned_start_tokens is not None
+    loop_detector = LoopDetector(context_tokens, loop_tokens) if loop_tokens > 0 else None
+    outcome_watcher = OutcomeWatcher() if watch_outcome else None
+    if past is not None:
+        pasts = past
+        next_token = context[past_length(past):]
 
     penalty = None
-    if not repetition_penalty_range is None and not repetition_penalty_slope is None and repetition_penalty_range > 0:
-        penalty = (torch.arange(repetition_penalty_range)/(repetition_penalty_range - 1)) * 2. - 1
-        penalty = (repetition_penalty_slope * penalty) / (1 + torch.abs(penalty) * (repetition_penalty_slope - 1))
-        penalty = 1 + ((penalty + 1) / 2) * (repetition_penalty - 1)
+    if repetition_penalty != 1.0:
+        penalty = RepetitionPenalty(context, model.config.vocab_size, repetition_penalty, repetition_penalty_range,
+                                    repetition_penalty_slope)
 
     with torch.no_grad():
         for j in range(length):
@@ -140,53 +522,47 @@ def sample_sequence(
             else:
                 input_ids_next = next_token
 
-            # Note: we could also use 'past' with GPT-2/Transfo-XL/XLNet/CTRL (cached hidden-states)
-            model_kwargs = {"past": pasts, "use_cache": True}
-            model_inputs = model.prepare_inputs_for_generation(generated.unsqueeze(0), **model_kwargs)
-            model_outputs = model(**model_inputs, return_dict=True)
+            if pasts is not None and next_token.shape[0] > 1:
+                # prefill the part of the context that isn't covered by the reused cache
+                model_inputs = {"input_ids": next_token.unsqueeze(0), "past_key_values": pasts, "use_cache": True}
+            else:
+                # Note: we could also use 'past' with GPT-2/Transfo-XL/XLNet/CTRL (cached hidden-states)
+                model_kwargs = {"past": pasts, "use_cache": True}
+                model_inputs = model.prepare_inputs_for_generation(generated.unsqueeze(0), **model_kwargs)
+            tracer.count("prefill tokens" if j == 0 else "decode steps", model_inputs["input_ids"].size(-1))
+            with tracer.span("prefill" if j == 0 else "forward"):
+                model_outputs = model(**model_inputs, return_dict=True)
             logits, pasts = model_outputs.logits, model_outputs.past_key_values
-            logits = logits[0, -1, :].float()
-
-            # Originally the order was Temperature, Repetition Penalty, then top-k/p
-            if settings.getboolean('top-p-first'):
-                logits = top_k_top_p_filtering(logits, top_k=top_k, top_p=top_p)
+            with tracer.span("logits.float"):
+                logits = logits[0, -1, :].float()
+            if constrained:
+                logits[banned_start_tokens] = -float("Inf")
 
-            logits = logits / (temperature if temperature > 0 else 1.0)
-
-            # repetition penalty from CTRL (https://arxiv.org/abs/1909.05858) plus range limit
-            if repetition_penalty != 1.0:
-                if penalty is not None:
-                    penalty_len = min(generated.shape[0], repetition_penalty_range)
-                    penalty_context = generated[-repetition_penalty_range:]
-                    score = torch.gather(logits, 0, penalty_context)
-                    penalty = penalty.type(score.dtype).to(score.device)
-                    penalty_window = penalty[-penalty_len:]
-                    score = torch.where(score < 0, score * penalty_window, score / penalty_window)
-                    logits.scatter_(0, penalty_context, score)
-                else:
-                    score = torch.gather(logits, 0, generated)
-                    score = torch.where(score < 0, score * repetition_penalty, score / repetition_penalty)
-                    logits.scatter_(0, generated, score)
-
-            if not settings.getboolean('top-p-first'):
-                logits = top_k_top_p_filtering(logits, top_k=top_k, top_p=top_p)
-
-            if temperature == 0:  # greedy sampling:
-                next_token = torch.argmax(logits, dim=-1).unsqueeze(-1)
-            else:
-                next_token = torch.multinomial(
-                    F.softmax(logits, dim=-1), num_samples=1
-                )
-            generated = torch.cat((generated, next_token), dim=-1)
-            # Decode into plain text
-            o = generated[len(context_tokens):].tolist()
-            generated.text = tokenizer.decode(
-                o, clean_up_tokenization_spaces=False, skip_special_tokens=True
-            )
-            if use_ptoolkit():
-                clear_lines(clines)
-                generated.text = format_result(generated.text)
-                clines = output(generated.text, "ai-text")
+            next_token = sample_token(logits, temperature, top_k, top_p, penalty,
+                                      settings.getboolean('top-p-first'))
+            tokens[generated.size(-1)] = next_token[0]
+            generated = tokens[:generated.size(-1) + 1]
+            if penalty is not None:
+                penalty.add(next_token)
+            # Decode only the new token into plain text
+            with tracer.span("decode"):
+                piece = detokenizer.add(next_token.item())
+            if constrained and USABLE_TEXT.search(piece):
+                constrained = False
+            if loop_detector is not None and loop_detector.add(detokenizer.ids[-1]):
+                keep = j + 1 - min(loop_detector.copied, j + 1)
+                logger.info("Stopping generation, the last %s tokens repeat the story", j + 1 - keep)
+                tracer.count("loops stopped")
+                detokenizer.truncate(keep)
+                generated = tokens[:len(context_tokens) + keep]
+                break
+            if outcome_watcher is not None and outcome_watcher.feed(piece) and SENTENCE_END.search(piece):
+                logger.info("Stopping generation at the end of the sentence, the player %s", outcome_watcher.outcome)
+                tracer.count("outcomes stopped")
+                break
+            if renderer.frame_due():
+                with tracer.span("redraw"):
+                    renderer.draw(format_result(detokenizer.text))
             if (
                     (stop_tokens is not None)
                     and (j > 4)
@@ -200,9 +576,92 @@ def sample_sequence(
                     j,
                 )
                 break
-    clear_lines(clines)
+    renderer.clear()
+    detokenizer.finish()
+    generated.text = format_result(detokenizer.text) if use_ptoolkit() else detokenizer.text
+    generated.pasts = pasts
     return generated
 
+def sample_sequences(
+        model,
+        length,
+        context,
+        num_samples,
+        temperature=1,
+        top_k=0,
+        top_p=0.9,
+        repetition_penalty=1.0,
+        repetition_penalty_range=512,
+        repetition_penalty_slope=3.33,
+        device="cpu",
+        stop_tokens=None,
+        stop_strings=None,
+        tokenizer=None,
+        past=None
+):
+    """
+    Generate num_samples continuations of the same context as one batch.
+    The context is prefilled once (on top of past, if given) and its cache is shared by every row.
+    A row is finished once it samples one of stop_tokens (after the same minimum as sample_sequence) or its text
+    contains one of stop_strings; decoding ends when all rows are finished.
+    Returns the generated texts, plus the batch-size-1 past_key_values of the context alone.
+    """
+    context = torch.tensor(context, dtype=torch.long, device=device)
+    detokenizers = [StreamingDetokenizer(tokenizer) for _ in range(num_samples)]
+    finished = [False] * num_samples
+    context_past = past
+
+    with torch.no_grad():
+        prefill = context[past_length(past):] if past is not None else context
+        tracer.count("prefill tokens", prefill.size(-1))
+        with tracer.span("prefill"):
+            model_outputs = model(input_ids=prefill.unsqueeze(0), past_key_values=past, use_cache=True,
+                                  return_dict=True)
+        context_past = model_outputs.past_key_values
+        logits = model_outputs.logits[:, -1, :].float().repeat(num_samples, 1)
+        pasts = expand_past(context_past, num_samples, context.size(-1) + length)
+        tokens = torch.empty((num_samples, context.size(-1) + length), dtype=torch.long, device=device)
+        tokens[:, :context.size(-1)] = context
+        generated = tokens[:, :context.size(-1)]
+        penalty = None
+        if repetition_penalty != 1.0:
+            penalty = RepetitionPenalty(generated, model.config.vocab_size, repetition_penalty,
+                                        repetition_penalty_range, repetition_penalty_slope)
+
+        for j in range(length):
+            if j > 0:
+                tracer.count("decode steps")
+                with tracer.span("forward"):
+                    model_outputs = model(input_ids=next_token, past_key_values=pasts, use_cache=True,
+                                          return_dict=True)
+                with tracer.span("logits.float"):
+                    logits, pasts = model_outputs.logits[:, -1, :].float(), model_outputs.past_key_values
+
+            next_token = sample_token(logits, temperature, top_k, top_p, penalty,
+                                      settings.getboolean('top-p-first'))
+            tokens[:, generated.size(-1)] = next_token[:, 0]
+            generated = tokens[:, :generated.size(-1) + 1]
+            if penalty is not None:
+                penalty.add(next_token)
+
+            with tracer.span("decode"):
+                for i, token in enumerate(next_token[:, 0].tolist()):
+                    if finished[i]:
+                        continue
+                    detokenizers[i].add(token)
+                    if stop_tokens is not None and j > 4 and token in stop_tokens:
+                        finished[i] = True
+                    elif stop_strings is not None and any(s in detokenizers[i].text for s in stop_strings):
+                        finished[i] = True
+            if all(finished):
+                logger.debug("Stopping batched generation, all %s rows are finished at token %s", num_samples, j)
+                break
+
+    for detokenizer in detokenizers:
+        detokenizer.finish()
+    return [d.text for d in detokenizers], context_past
+
+
 def truncate_multiple_sequences(seqs, max_len=100):
     """Truncate multiple sequences, longest first, removing first."""
     while sum(len(s) for s in seqs) > max_len:
@@ -227,6 +686,11 @@ class GPT2Generator:
         self.batch_size = 1
         self.max_history_tokens = 1024 - generate_num
         self.stop_token = "<|endoftext|>"
+        # past_key_values kept from the previous generation, and the tokens they were computed from
+        self.past = None
+        self.past_tokens = []
+        # tokens generate doesn't let a result start with, see get_empty_result_tokens
+        self.empty_result_tokens = None
 
         if isinstance(model_path, str):
             self.checkpoint_path = model_path
@@ -248,18 +712,47 @@ class GPT2Generator:
 
         # Load tokenizer and model
         model_class, tokenizer_class = MODEL_CLASSES["gpt2-experimental"] if settings.getboolean(
-            "gpt2_experimental") else MODEL_CLASSES["gpt2"]
+            "gpt2-experimental") else MODEL_CLASSES["gpt2"]
         if "gpt-neo" in str(model_path):
+            from transformers import GPTNeoForCausalLM
             self.max_history_tokens = 2048 - generate_num
             model_class = GPTNeoForCausalLM
-        self.tokenizer = tokenizer_class.from_pretrained(str(self.checkpoint_path))
-        self.model = model_class.from_pretrained(str(self.checkpoint_path))
-        self.model.to(self.dtype).to(self.device)
+        with startup.phase("tokenizer load"):
+            self.tokenizer = tokenizer_class.from_pretrained(str(self.checkpoint_path))
+        quantize = settings.get('quantize', 'off')
+        if quantize != 'off':
+            from quantize import QUANTIZE_MODES, load_quantized
+            if quantize not in QUANTIZE_MODES:
+                raise ValueError("quantize must be one of {}, got {}".format(QUANTIZE_MODES, quantize))
+        if quantize != 'off' and self.device.type != 'cpu':
+            logger.warning("quantize = {} only applies to CPU inference, ignoring it".format(quantize))
+            quantize = 'off'
+        self.quantize = quantize
+        if quantize == 'int8':
+            with startup.phase("weight load (int8)"):
+                self.model = load_quantized(model_class, self.checkpoint_path)
+        elif settings.getboolean('fast-load', False):
+            # converting and moving happen while loading
+            with startup.phase("weight load (fast-load)"):
+                self.model = load_converted(model_class, self.checkpoint_path, self.dtype, self.device)
+        else:
+            with startup.phase("weight load"):
+                self.model = model_class.from_pretrained(str(self.checkpoint_path))
+            with startup.phase("dtype/device move"):
+                self.model.to(self.dtype).to(self.device)
         self.model.eval()
+        tracer.enabled = settings.getboolean('instrumentation', False)
+        if self.device.type == 'cuda':
+            # otherwise the model's time shows up in whatever waits for it first
+            tracer.synchronize = torch.cuda.synchronize
+        if isinstance(self.model, GPT2LMHeadModelExperimental):
+            self.model.enable_static_cache(settings.getboolean('gpt2-experimental-static-cache', False))
+            self.model.set_attention_backend(settings.get('gpt2-experimental-attention', 'auto'))
 
     def sample_sequence(
             self, context_tokens=None, top_k=None, top_p=None, repetition_penalty=None, generate_num=None,
-            temperature=None, stop_tokens=None, repetition_penalty_range=None, repetition_penalty_slope=None
+            temperature=None, stop_tokens=None, repetition_penalty_range=None, repetition_penalty_slope=None,
+            banned_start_tokens=None, loop_tokens=0, watch_outcome=False
     ):
         assert (top_k is not None)
         assert (temperature is not None)
@@ -274,24 +767,99 @@ class GPT2Generator:
         repetition_penalty_slope = repetition_penalty_slope if repetition_penalty_slope is not None else self.repetition_penalty_slope
         length = len(context_tokens) + generate_num
 
-        out = sample_sequence(
-            model=self.model,
-            context=context_tokens,
-            length=generate_num,
-            # context=self.context,
-            temperature=temperature,
-            top_k=top_k,
-            top_p=top_p,
-            repetition_penalty=repetition_penalty,
-            repetition_penalty_range=repetition_penalty_range,
-            repetition_penalty_slope=repetition_penalty_slope,
-            device=self.device,
-            stop_tokens=stop_tokens,
-            tokenizer=self.tokenizer
-            # batch_size=self.batch_size,
-        )
+        past = self.reusable_past(context_tokens)
+        tracer.count("cached tokens", past_length(past) if past is not None else 0)
+        with tracer.span("sample_sequence"):
+            out = sample_sequence(
+                model=self.model,
+                context=context_tokens,
+                length=generate_num,
+                # context=self.context,
+                temperature=temperature,
+                top_k=top_k,
+                top_p=top_p,
+                repetition_penalty=repetition_penalty,
+                repetition_penalty_range=repetition_penalty_range,
+                repetition_penalty_slope=repetition_penalty_slope,
+                device=self.device,
+                stop_tokens=stop_tokens,
+                tokenizer=self.tokenizer,
+                past=past,
+                banned_start_tokens=banned_start_tokens,
+                loop_tokens=loop_tokens,
+                watch_outcome=watch_outcome
+                # batch_size=self.batch_size,
+            )
+        if out.pasts is not None:
+            self.past = out.pasts
+            self.past_tokens = out.tolist()[:past_length(out.pasts)]
         return out
 
+    def reusable_past(self, context_tokens):
+        """
+        Returns the cached past_key_values cropped to the longest prefix shared with context_tokens, or None.
+        At least one context token is always left uncached so the model has something to predict from.
+        """
+        reuse = min(common_prefix_length(self.past_tokens, context_tokens), len(context_tokens) - 1)
+        past = crop_past(self.past, reuse) if self.past is not None and reuse > 0 else None
+        # drop our own reference so an unusable cache can be freed before the prefill
+        self.clear_past()
+        logger.debug("Reusing %s of %s context tokens from the previous generation", reuse if past else 0,
+                     len(context_tokens))
+        return past
+
+    def warmup(self):
+        """Runs the model once on a few tokens. The first forward pass is slower than the ones after it."""
+        with torch.no_grad():
+            self.model(input_ids=torch.tensor([self.tokenizer.encode("Hello there")], device=self.device),
+                       return_dict=True)
+
+    def get_empty_result_tokens(self):
+        """The empty_result_token_ids of our tokenizer, found the first time they're needed."""
+        if self.empty_result_tokens is None:
+            self.empty_result_tokens = torch.tensor(empty_result_token_ids(self.tokenizer), dtype=torch.long,
+                                                    device=self.device)
+        return self.empty_result_tokens
+
+    def clear_past(self):
+        self.past = None
+        self.past_tokens = []
+
+    def past_snapshot_tags(self):
+        """What a snapshot of the cache depends on besides its tokens: the model's weights, dtype and setup."""
+        checkpoint_path = Path(self.checkpoint_path)
+        model = fingerprint(checkpoint_path, type(self.model)) if checkpoint_path.is_dir() \
+            else {"checkpoint": str(checkpoint_path)}
+        return {
+            "model": model,
+            "dtype": str(self.dtype),
+            "quantize": self.quantize,
+            "static_cache": isinstance(self.model, GPT2LMHeadModelExperimental) and self.model.use_static_cache,
+        }
+
+    def save_past(self, path):
+        """
+        Keeps the cache of the last generation's context in path, so a later session can skip prefilling it.
+        Returns whether it was written, see kvsnapshot.save_past.
+        """
+        if self.past is None:
+            return False
+        import kvsnapshot
+        with tracer.span("save past"):
+            return kvsnapshot.save_past(path, self.past, self.past_tokens, self.past_snapshot_tags(),
+                                        settings.get('kv-snapshot-compression', 'off'),
+                                        settings.getint('kv-snapshot-max-mb', 1024) * 2 ** 20)
+
+    def load_past(self, path):
+        """Restores a cache saved by save_past if it was made by this model and setup, returns whether it did."""
+        import kvsnapshot
+        with tracer.span("load past"):
+            snapshot = kvsnapshot.load_past(path, self.past_snapshot_tags(), self.model, self.dtype, self.device)
+        if snapshot is None:
+            return False
+        self.past, self.past_tokens = snapshot
+        return True
+
     def result_replace(self, result, allow_action=False):
         # logger.debug("BEFORE RESULT_REPLACE: `%s`", repr(result))
 
@@ -315,16 +883,29 @@ class GPT2Generator:
 
         return result
 
+    def encode_prompt(self, prompt):
+        """Encodes the permanent prompt (context and memory) the way memory_merge does."""
+        return self.tokenizer.encode(prompt, add_special_tokens=False, add_prefix_space=True)
+
+    def encode_story(self, text, first=False):
+        """Encodes a piece of story text the way memory_merge does. Only the first piece gets the whitespace hack."""
+        return hackyEncode(self.tokenizer, text) if first else self.tokenizer(text, verbose=False).input_ids
+
+    def merge_chunks(self, prompt_tokens, chunks):
+        return memory_merge_chunks(prompt_tokens, chunks, self.max_history_tokens)
+
     def generate_raw(
-            self, context, prompt='', generate_num=None, temperature=None, top_k=None, top_p=None,
-            repetition_penalty=None, repetition_penalty_range=512, repetition_penalty_slope=3.33, stop_tokens=None
+            self, context='', prompt='', generate_num=None, temperature=None, top_k=None, top_p=None,
+            repetition_penalty=None, repetition_penalty_range=512, repetition_penalty_slope=3.33, stop_tokens=None,
+            context_tokens=None, banned_start_tokens=None, loop_tokens=0, watch_outcome=False
     ):
         assert (top_k is not None)
         assert (temperature is not None)
         assert (top_p)
         assert (repetition_penalty)
 
-        context_tokens = memory_merge(prompt, context, self.tokenizer, self.max_history_tokens)
+        if context_tokens is None:
+            context_tokens = memory_merge(prompt, context, self.tokenizer, self.max_history_tokens)
 
         logger.debug(
             "Text passing into model `%r`",
@@ -347,24 +928,62 @@ class GPT2Generator:
                 repetition_penalty_range=repetition_penalty_range,
                 repetition_penalty_slope=repetition_penalty_slope,
                 stop_tokens=stop_tokens,
+                banned_start_tokens=banned_start_tokens,
+                loop_tokens=loop_tokens,
+                watch_outcome=watch_outcome,
             )
             text += out.text
             generated += 1
             # disabled clean up of spaces, see what effect this has TODO
-            if self.stop_token:
-                index = text.find(self.stop_token)
-                if index == -1:
-                    index = None
+            text = self.cut_stop_token(text)
+        return text
+
+    def generate_raw_batch(
+            self, context='', prompt='', num_samples=1, generate_num=None, temperature=None, top_k=None, top_p=None,
+            repetition_penalty=None, repetition_penalty_range=512, repetition_penalty_slope=3.33, stop_tokens=None,
+            stop_strings=None, context_tokens=None
+    ):
+        """Like generate_raw, but samples num_samples continuations of the same context in one batched decode."""
+        assert (top_k is not None)
+        assert (temperature is not None)
+        assert (top_p)
+        assert (repetition_penalty)
+
+        if context_tokens is None:
+            context_tokens = memory_merge(prompt, context, self.tokenizer, self.max_history_tokens)
+        past = self.reusable_past(context_tokens)
+        tracer.count("cached tokens", past_length(past) if past is not None else 0)
+        with tracer.span("sample_sequences"):
+            texts, context_past = sample_sequences(
+                model=self.model,
+                length=generate_num if generate_num is not None else self.generate_num,
+                context=context_tokens,
+                num_samples=num_samples,
+                temperature=temperature,
+                top_k=top_k,
+                top_p=top_p,
+                repetition_penalty=repetition_penalty,
+                repetition_penalty_range=repetition_penalty_range,
+                repetition_penalty_slope=repetition_penalty_slope,
+                device=self.device,
+                stop_tokens=stop_tokens,
+                stop_strings=stop_strings,
+                tokenizer=self.tokenizer,
+                past=past
+            )
+        # keep the shared context's cache, the story carries on from it
+        self.past = context_past
+        self.past_tokens = context_tokens
+        return [self.cut_stop_token(text) for text in texts]
+
+    def cut_stop_token(self, text):
+        if self.stop_token:
+            index = text.find(self.stop_token)
+            if index != -1:
                 text = text[:index]
-            if stop_tokens is not None:
-                for stop_token in stop_tokens:
-                    index = text.find(self.stop_token)
-                    if index == -1:
-                        index = None
-                    text = text[:index]
         return text
 
-    def generate(self, context, prompt='', temperature=None, top_p=None, top_k=None, repetition_penalty=None, repetition_penalty_range=512, repetition_penalty_slope=3.33, depth=0):
+    def generate(self, context='', prompt='', temperature=None, top_p=None, top_k=None, repetition_penalty=None, repetition_penalty_range=512, repetition_penalty_slope=3.33, depth=0, context_tokens=None):
         assert (top_k is not None)
         assert (temperature is not None)
         assert (top_p)
@@ -374,21 +993,26 @@ class GPT2Generator:
         # prompt = [self.prompt_replace(p) for p in prompt]
 
         # logger.debug("AFTER PROMPT_REPLACE is: `%r`", repr(prompt))
-        assert (prompt + context)
+        assert (prompt + context) or context_tokens
+        tracer.count("retries" if depth > 0 else "generations")
 
-        text = self.generate_raw(
-            context, prompt, temperature=temperature, top_k=top_k, top_p=top_p, repetition_penalty=repetition_penalty, repetition_penalty_range=repetition_penalty_range, repetition_penalty_slope=repetition_penalty_slope,
-            stop_tokens=self.tokenizer.encode(["<|endoftext|>", ">"])
-        )
+        with tracer.span("generate_raw"):
+            text = self.generate_raw(
+                context, prompt, temperature=temperature, top_k=top_k, top_p=top_p, repetition_penalty=repetition_penalty, repetition_penalty_range=repetition_penalty_range, repetition_penalty_slope=repetition_penalty_slope,
+                stop_tokens=self.tokenizer.encode(["<|endoftext|>", ">"]), context_tokens=context_tokens,
+                banned_start_tokens=self.get_empty_result_tokens(), loop_tokens=settings.getint('loop-tokens', 16),
+                watch_outcome=True
+            )
 
         logger.debug("Generated result is: `%r`", repr(text))
 
-        result = self.result_replace(text)
+        with tracer.span("result_replace"):
+            result = self.result_replace(text)
 
         if (depth > 6) and len(result) == 0:
             # Sometimes it keeps generating a story startng with an action (">"), if it's tried a few times and it keeps
             # happening, lets let it keep action text which starts in ">"
-            # We could just blacklist that token and force it to generate something else. TODO
+            # The tokens that start an empty result are banned until there's usable text, so this should be rare
             result = self.result_replace(text, allow_action=True)
             logger.info(
                 "Model generated empty text after formatting `%r`. Trying to format less with allow_action=True. `%r`",
@@ -401,11 +1025,13 @@ class GPT2Generator:
             if depth < 20:
                 logger.info("Model generated empty text trying again %r", depth)
                 return self.generate(
-                    prompt, context, temperature=temperature, top_p=top_p, top_k=top_k,
-                    repetition_penalty=repetition_penalty, repetition_penalty_range=repetition_penalty_range, repetition_penalty_slope=repetition_penalty_slope, depth=depth + 1
+                    context, prompt, temperature=temperature, top_p=top_p, top_k=top_k,
+                    repetition_penalty=repetition_penalty, repetition_penalty_range=repetition_penalty_range, repetition_penalty_slope=repetition_penalty_slope, depth=depth + 1,
+                    context_tokens=context_tokens
                 )
             else:
                 logger.warn(
                     "Model generated empty text %r times. Try another action", depth
                 )
         return result
+
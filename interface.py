@@ -26,6 +26,8 @@ def instructions():
     print('  "/load"                  Loads a game from a file in the game\'s save directory')
     print('  "/summarize"             Create a new story using by summarizing your previous one')
     print('  "/help"                  Prints these instructions again')
+    print('  "/stats [on|off|reset|save FILE]" Shows where generation time goes, or saves it as a Chrome trace')
+    print('  "/find [WORDS]"          Lists the saves and prompts containing the words')
     print('  "/set [SETTING] [VALUE]" Sets the specified setting to the specified value.:')
     for k, v in setting_info.items():
         print(pad_text('        ' + k, 27) + v[0] + (" " if v[0] else "") +
@@ -0,0 +1,263 @@
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+from getconfig import logger
+
+# appended records are fsynced together, at most this many seconds apart
+FSYNC_INTERVAL = 5.0
+# the key of the snapshot holding the seq of the last record it includes
+SEQ_KEY = "journal-seq"
+
+
+def write_atomic(path, text):
+    """Writes text to path through a temporary file, so path always holds either the old or the new text."""
+    path = Path(path)
+    tmp_path = path.with_name(path.name + '.tmp')
+    with tmp_path.open('w', encoding='utf-8') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(str(tmp_path), str(path))
+    try:
+        # makes the rename itself durable, not possible on windows
+        fd = os.open(str(path.parent), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+
+def diff(old, new):
+    """
+    The records turning the dict old into new: lists are spliced from the first entry that changed, anything else
+    is set whole. Stories only change at the end of their lists, so the records stay the size of a turn.
+    """
+    records = []
+    for key, value in new.items():
+        before = old.get(key)
+        if isinstance(value, list) and isinstance(before, list):
+            n = min(len(before), len(value))
+            at = n
+            if before[:n] != value[:n]:
+                at = next(i for i in range(n) if before[i] != value[i])
+            if at < len(before) or at < len(value):
+                records.append({"splice": key, "at": at, "items": value[at:]})
+        elif key not in old or before != value:
+            records.append({"set": key, "value": value})
+    return records
+
+
+def apply(state, record):
+    """Applies a record from diff() to state. Applying records again that are already in state changes nothing."""
+    if "splice" in record:
+        items = state.setdefault(record["splice"], [])
+        del items[record["at"]:]
+        items.extend(record["items"])
+    else:
+        value = record["value"]
+        state[record["set"]] = list(value) if isinstance(value, list) else value
+
+
+def copy_state(d):
+    return {key: list(value) if isinstance(value, list) else value for key, value in d.items()}
+
+
+class SaveJournal:
+    """
+    A save made of a snapshot, the json file Story.to_dict() has always been saved as, and a journal next to it
+    (name.journal) with one json record per line for what changed since. A turn appends a record the size of the
+    turn, instead of rewriting the whole story. Once the journal grows past the snapshot, the snapshot is rewritten
+    atomically and the journal removed, so saving costs a constant amount per turn on average.
+    A crash while appending leaves at most a torn last line, which is ignored on load. Records are numbered, and the
+    snapshot holds the number of the last one it includes: replaying the records of a journal a crash kept from
+    being removed after the snapshot was replaced would undo what changed since, so load skips them.
+    Saves without a journal, and older versions reading the snapshot, just see the story as of the last compaction.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.journal_path = self.path.with_suffix('.journal')
+        self.state = None  # what's on disk, None until it's known
+        self.needs_snapshot = True
+        self.last_fsync = 0.0
+        self.unsynced = False  # records were appended since the last fsync
+        self.seq = 0  # of the last record written, or of the snapshot
+
+    def load(self):
+        """Reads the snapshot and replays the journal, returns the story as a dict for Story.from_dict."""
+        with self.path.open('r', encoding='utf-8') as f:
+            state = json.load(f)
+        self.seq = state.pop(SEQ_KEY, 0)
+        self.needs_snapshot = False
+        if self.journal_path.exists():
+            with self.journal_path.open('r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        seq = record.get("seq")  # None in journals from before records were numbered
+                        if seq is not None and seq <= self.seq:
+                            continue  # already in the snapshot
+                        apply(state, record)
+                        self.seq = seq if seq is not None else self.seq
+                    except (ValueError, KeyError, TypeError, AttributeError):
+                        logger.warning("Ignoring the end of %s, it wasn't written completely", self.journal_path)
+                        # appending after a torn line would corrupt the next record
+                        self.needs_snapshot = True
+                        break
+        self.state = copy_state(state)
+        return state
+
+    def save(self, d):
+        """Saves the dict d, returns the number of records appended (0 when a new snapshot was written)."""
+        if self.state is None or self.needs_snapshot or self.journal_too_big():
+            self.snapshot(d)
+            return 0
+        records = diff(self.state, d)
+        if records:
+            for seq, record in enumerate(records, self.seq + 1):
+                record["seq"] = seq
+            with self.journal_path.open('a', encoding='utf-8') as f:
+                f.write(''.join(json.dumps(record) + '\n' for record in records))
+                f.flush()
+                self.unsynced = True
+                if time.monotonic() - self.last_fsync >= FSYNC_INTERVAL:
+                    os.fsync(f.fileno())
+                    self.last_fsync = time.monotonic()
+                    self.unsynced = False
+            self.seq += len(records)
+            for record in records:
+                apply(self.state, record)
+        return len(records)
+
+    def snapshot(self, d):
+        os.makedirs(str(self.path.parent), exist_ok=True)
+        if self.state is None and self.journal_path.exists():
+            # left by whatever was saved here before, its numbers don't follow this snapshot's
+            self.journal_path.unlink()
+        write_atomic(self.path, json.dumps(dict(d, **{SEQ_KEY: self.seq})))
+        if self.journal_path.exists():
+            self.journal_path.unlink()
+        self.state = copy_state(d)
+        self.needs_snapshot = False
+        self.unsynced = False
+
+    def sync(self):
+        """fsyncs the records appended since the last fsync, if any."""
+        if not self.unsynced:
+            return
+        if self.journal_path.exists():
+            with self.journal_path.open('a', encoding='utf-8') as f:
+                os.fsync(f.fileno())
+        self.last_fsync = time.monotonic()
+        self.unsynced = False
+
+    def journal_too_big(self):
+        try:
+            return self.journal_path.stat().st_size > self.path.stat().st_size
+        except OSError:
+            # no journal yet, or the snapshot went missing, which the snapshot written then fixes
+            return not self.path.exists()
+
+
+class SaveWriter:
+    """
+    Writes saves on a background thread, so a slow disk doesn't hold up the game. The state is copied when it's
+    submitted, and if saves of the same file queue up only the latest one is written.
+    flush() waits until everything submitted is written and fsynced, call it before anything that could end the
+    process. Appended records that saving didn't fsync are fsynced once no save came for FSYNC_INTERVAL, or by flush().
+    """
+
+    def __init__(self):
+        self.pending = {}  # path: (journal, state)
+        self.unsynced = {}  # path: journal, for the journals with records that weren't fsynced yet
+        self.sync_requested = False
+        self.writing = False
+        self.errors = {}  # path: why its latest save failed, a save of the path that works clears it
+        # called with the path and the state after each successful save, on the writer's thread
+        self.on_saved = []
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def submit(self, journal, d):
+        with self.condition:
+            self.pending[journal.path] = (journal, copy_state(d))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="save-writer", daemon=True)
+                self.thread.start()
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending or self.sync_requested,
+                                        FSYNC_INTERVAL if self.unsynced else None)
+                self.writing = True
+                if not self.pending:
+                    # flush() is waiting, or nothing was saved for a while
+                    journals, self.unsynced = list(self.unsynced.values()), {}
+                else:
+                    journals = None
+                    path = next(iter(self.pending))
+                    journal, state = self.pending.pop(path)
+            if journals is not None:
+                self.sync(journals)
+                continue
+            error = None
+            try:
+                journal.save(state)
+            except Exception as e:  # whatever it is, the thread has to keep going or flush() would never return
+                # the next save writes the whole story again
+                journal.needs_snapshot = True
+                logger.warning("Could not save %s: %s", path, e)
+                error = e
+            else:
+                for callback in self.on_saved:
+                    try:
+                        callback(path, state)
+                    except Exception as e:
+                        logger.warning("Error after saving %s: %s", path, e)
+            with self.condition:
+                self.writing = False
+                if error is not None:
+                    self.errors[path] = error
+                else:
+                    self.errors.pop(path, None)
+                    if journal.unsynced:
+                        self.unsynced[path] = journal
+                self.condition.notify_all()
+
+    def sync(self, journals):
+        errors = {}
+        for journal in journals:
+            try:
+                journal.sync()
+            except OSError as e:
+                logger.warning("Could not save %s: %s", journal.path, e)
+                errors[journal.path] = e
+        with self.condition:
+            self.writing = False
+            self.sync_requested = False
+            self.errors.update(errors)
+            self.condition.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        Waits for the submitted saves to be written and fsynced. Returns {path: error} for the saves that failed since
+        the last flush, and weren't written by a later save of the same path.
+        """
+        with self.condition:
+            if self.thread is not None:
+                self.sync_requested = True
+                self.condition.notify_all()
+                self.condition.wait_for(lambda: not self.pending and not self.writing and not self.sync_requested,
+                                        timeout)
+            errors, self.errors = self.errors, {}
+        return errors
+
+
+save_writer = SaveWriter()
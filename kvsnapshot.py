@@ -0,0 +1,104 @@
+import hashlib
+import io
+import json
+import os
+import zlib
+from pathlib import Path
+
+import torch
+from getconfig import logger
+from gpt2 import StaticCache
+
+COMPRESSION_MODES = ("off", "zlib", "half")
+
+
+def tokens_hash(tokens):
+    return hashlib.sha256(','.join(str(t) for t in tokens).encode()).hexdigest()
+
+
+def map_past(past, fn):
+    """Applies fn to every tensor of a past_key_values structure, keeping its nesting."""
+    if torch.is_tensor(past):
+        return fn(past)
+    return tuple(map_past(p, fn) for p in past)
+
+
+def torch_load(data, device):
+    try:
+        return torch.load(io.BytesIO(data), map_location=device, weights_only=True)
+    except TypeError:  # torch < 1.13
+        return torch.load(io.BytesIO(data), map_location=device)
+
+
+def save_past(path, past, tokens, tags, compression="off", max_bytes=None):
+    """
+    Writes past (covering tokens) to path: a json header line with tags, what it was computed from, then the
+    tensors. Returns False, and removes the stale snapshot, when it would be bigger than max_bytes.
+    """
+    path = Path(path)
+    if compression not in COMPRESSION_MODES:
+        raise ValueError("kv-snapshot-compression must be one of {}, got {}".format(COMPRESSION_MODES, compression))
+    if isinstance(past, StaticCache):
+        past = {"static_cache": past.buffer[..., :past.length, :]}
+    else:
+        past = {"past": past}
+    # torch.save writes the whole storage under a view: copy=True leaves only the tensor's own elements, not the rest
+    # of the n_ctx long static buffer, or the query next to a key fresh out of c_attn
+    dtype = torch.float16 if compression == "half" else None
+    convert = lambda t: t.detach().to('cpu', dtype, copy=True)
+    past = {kind: map_past(value, convert) for kind, value in past.items()}
+    buffer = io.BytesIO()
+    torch.save(past, buffer)
+    data = buffer.getvalue()
+    if compression == "zlib":
+        data = zlib.compress(data, 1)
+    if max_bytes is not None and len(data) > max_bytes:
+        logger.info("Not keeping the model's cache in %s, it would take %.0f MB", path, len(data) / 2 ** 20)
+        if path.exists():
+            path.unlink()
+        return False
+    header = dict(tags, tokens=list(tokens), tokens_sha256=tokens_hash(tokens), compression=compression)
+    tmp_path = path.with_name(path.name + '.tmp')
+    with tmp_path.open('wb') as f:
+        f.write(json.dumps(header).encode() + b'\n')
+        f.write(data)
+    os.replace(str(tmp_path), str(path))
+    return True
+
+
+def load_past(path, tags, model, dtype, device):
+    """
+    Reads a snapshot written by save_past, returns (past, tokens), or None if there's none or it was made by another
+    model, dtype or setup than tags describes, or its tokens don't match their hash.
+    """
+    path = Path(path)
+    if not path.exists():
+        return None
+    with path.open('rb') as f:
+        try:
+            header = json.loads(f.readline().decode())
+        except ValueError:
+            logger.warning("Ignoring %s, it's not a cache snapshot", path)
+            return None
+        if any(header.get(key) != value for key, value in tags.items()):
+            logger.info("Ignoring %s, it was made with another model or settings", path)
+            return None
+        tokens = header.get("tokens", [])
+        if tokens_hash(tokens) != header.get("tokens_sha256"):
+            logger.warning("Ignoring %s, its tokens don't match their hash", path)
+            return None
+        data = f.read()
+    try:
+        if header["compression"] == "zlib":
+            data = zlib.decompress(data)
+        past = torch_load(data, device)
+    except Exception as e:
+        logger.warning("Could not read %s: %s", path, e)
+        return None
+    if "static_cache" in past:
+        cache = model.get_static_cache(1)
+        filled = past["static_cache"]
+        cache.buffer[..., :filled.size(-2), :] = filled.to(cache.buffer.dtype)
+        cache.length = filled.size(-2)
+        return cache, tokens
+    return map_past(past["past"], lambda t: t.to(dtype)), tokens
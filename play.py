@@ -1,15 +1,21 @@
+from profiler import startup, tracer
+import threading
 import traceback
 from pathlib import Path
 from datetime import datetime
 
 import gc
-import torch
 
-from getconfig import config, setting_info
-from storymanager import Story
-from utils import *
-from gpt2generator import GPT2Generator
-from interface import instructions
+# torch and transformers are only imported once the model loads, see load_generator
+with startup.phase("config parse"):
+    from getconfig import config, setting_info
+with startup.phase("imports"):
+    from catalog import SaveCatalog
+    from journal import SaveJournal, save_writer
+    from storymanager import Story
+    from storyindex import StoryIndex, describe_match
+    from utils import *
+    from interface import instructions
 
 if not use_ptoolkit() and os.name == 'nt':
     try:
@@ -25,12 +31,86 @@ if not use_ptoolkit() and os.name == 'nt':
 
 logger.info("Colab detected: {}".format(in_colab()))
 
+save_catalog = SaveCatalog(Path("saves"))
+story_index = StoryIndex(Path("saves"), Path("prompts"))
+save_writer.on_saved.append(save_catalog.update)
+save_writer.on_saved.append(story_index.update_save)
 
-def get_generator():
-    output(
-        "\nInitializing AI Engine! (This might take a few minutes)",
-        "loading-message", end="\n\n"
+
+class GeneratorHandle:
+    """
+    Loads a GPT2Generator on a background thread. Attribute access waits for the load to finish, so the handle can
+    be given to a Story in place of the generator: nothing blocks until the first generation needs the model.
+    If the load fails, fallback() is called for a generator instead when it's first needed.
+    """
+
+    def __init__(self, load, fallback=None):
+        self._load = load
+        self._fallback = fallback
+        self._generator = None
+        self._error = None
+        self._done = threading.Event()
+        threading.Thread(target=self._run, name="generator-loader", daemon=True).start()
+
+    def _run(self):
+        try:
+            self._generator = self._load()
+        except Exception as e:
+            self._error = e
+        finally:
+            self._done.set()
+
+    def ready(self):
+        return self._done.is_set()
+
+    def wait(self):
+        """Returns the generator, showing a progress indicator while it's still loading."""
+        if not self._done.is_set():
+            output("Waiting for the AI engine to finish loading", "loading-message", end="")
+            while not self._done.wait(1):
+                print('.', end='', flush=True)
+            print('\r\x1B[K', end='', flush=True)
+        if self._error is not None:
+            if self._fallback is None:
+                raise self._error
+            logger.error("Could not load the model: {}".format(self._error))
+            self._error = None
+            self._generator = self._fallback()
+        return self._generator
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.wait(), name)
+
+
+def load_generator(model):
+    with startup.phase("imports (torch, transformers)"):
+        from gpt2generator import GPT2Generator
+    return GPT2Generator(
+        model_path=model,
+        generate_num=settings.getint("generate-num"),
+        temperature=settings.getfloat("temp"),
+        top_k=settings.getint("top-keks"),
+        top_p=settings.getfloat("top-p"),
+        repetition_penalty=settings.getfloat("rep-pen"),
+        repetition_penalty_range=settings.getint("rep-pen-range"),
+        repetition_penalty_slope=settings.getfloat("rep-pen-slope"),
     )
+
+
+def get_generator(background=False):
+    """
+    Picks a model and loads it. With background, the model loads on another thread and a GeneratorHandle is
+    returned right away, which waits for it the first time it's used.
+    """
+    if background:
+        output("\nInitializing AI Engine in the background!", "loading-message", end="\n\n")
+    else:
+        output(
+            "\nInitializing AI Engine! (This might take a few minutes)",
+            "loading-message", end="\n\n"
+        )
     models = [x for x in Path('models').iterdir() if x.is_dir()]
     generator = None
     failed_env_load = False
@@ -61,16 +141,11 @@ def get_generator():
                     model = models[0]
                     logger.info("Using model: " + str(model))
                 assert isinstance(model, Path)
-            generator = GPT2Generator(
-                model_path=model,
-                generate_num=settings.getint("generate-num"),
-                temperature=settings.getfloat("temp"),
-                top_k=settings.getint("top-keks"),
-                top_p=settings.getfloat("top-p"),
-                repetition_penalty=settings.getfloat("rep-pen"),
-                repetition_penalty_range=settings.getint("rep-pen-range"),
-                repetition_penalty_slope=settings.getfloat("rep-pen-slope"),
-            )
+            if background:
+                # if it fails, the player picks another model when the story needs one
+                generator = GeneratorHandle(lambda: load_generator(model), fallback=get_generator)
+            else:
+                generator = load_generator(model)
             break
         except OSError:
             if len(models) == 0:
@@ -248,39 +323,119 @@ def save_story(story, file_override=None, autosave=False):
     savefile = os.path.splitext(savefile.strip())[0]
     savefile = re.sub(r"^ *saves *[/\\] *(.*) *(?:\.json)?", "\\1", savefile).strip()
     story.savefile = savefile
-    savedata = story.to_json()
-    finalpath = "saves/" + savefile + ".json"
+    finalpath = Path("saves", savefile + ".json")
     try:
-        os.makedirs(os.path.dirname(finalpath), exist_ok=True)
+        os.makedirs(str(finalpath.parent), exist_ok=True)
     except OSError:
         if not autosave:
             output("Error when creating subdirectory; aborting. ", "error")
-    with open(finalpath, 'w') as f:
-        try:
-            f.write(savedata)
-            if not autosave:
-                output("Successfully saved to " + savefile, "message")
-        except IOError:
-            if not autosave:
-                output("Unable to write to file; aborting. ", "error")
+    if story.journal is None or story.journal.path != finalpath:
+        story.journal = SaveJournal(finalpath)
+    # autosaves are written in the background, see save_writer.flush() for where they're waited for
+    save_writer.submit(story.journal, story.to_dict())
+    if not autosave:
+        errors = save_writer.flush()
+        for path in errors:
+            if path != finalpath:
+                output("Could not autosave to {}. ".format(path), "error")
+        if finalpath in errors:
+            output("Unable to write to file; aborting. ", "error")
+        else:
+            save_past(story)
+            output("Successfully saved to " + savefile, "message")
+
+
+def save_past(story):
+    """Keeps the model's cache next to the story's save if kv-snapshots is on, see GPT2Generator.save_past."""
+    generator = story.generator
+    if not settings.getboolean("kv-snapshots", False) or story.journal is None \
+            or (isinstance(generator, GeneratorHandle) and not generator.ready()):
+        return
+    try:
+        generator.save_past(story.journal.path.with_suffix(".kv"))
+    except (IOError, OSError, ValueError) as e:
+        logger.warning("Could not save the model's cache: %s", e)
+
+
+def restore_past(story):
+    """Gives the model the cache kept with the story's save, so the first generation doesn't prefill it again."""
+    if not settings.getboolean("kv-snapshots", False) or story.journal is None:
+        return
+    path = story.journal.path.with_suffix(".kv")
+    if path.exists() and story.generator.load_past(path):
+        logger.info("Restored the model's cache from %s", path)
 
 
 def load_story(f, gen):
-    with f.open('r', encoding="utf-8") as file:
-        try:
-            story = Story(gen, "")
-            savefile = os.path.splitext(file.name.strip())[0]
-            savefile = re.sub(r"^ *saves *[/\\] *(.*) *(?:\.json)?", "\\1", savefile).strip()
-            story.savefile = savefile
-            story.from_json(file.read())
-            return story, story.context, story.actions[-1] if len(story.actions) > 0 else ""
-        except FileNotFoundError:
-            output("Save file not found. ", "error")
-        except IOError:
-            output("Something went wrong; aborting. ", "error")
+    try:
+        story = Story(gen, "")
+        savefile = os.path.splitext(str(f).strip())[0]
+        savefile = re.sub(r"^ *saves *[/\\] *(.*) *(?:\.json)?", "\\1", savefile).strip()
+        story.savefile = savefile
+        story.journal = SaveJournal(f)
+        story.from_dict(story.journal.load())
+        return story, story.context, story.actions[-1] if len(story.actions) > 0 else ""
+    except FileNotFoundError:
+        output("Save file not found. ", "error")
+    except IOError:
+        output("Something went wrong; aborting. ", "error")
     return None, None, None
 
 
+def describe_save(path, mtime, turns, snippet):
+    name = save_catalog.key(path)[:-len(".json")]
+    details = "{} turns, {}".format(turns, datetime.fromtimestamp(mtime).strftime("%Y-%m-%d %H:%M")) \
+        if turns is not None else "unreadable"
+    line = "{}  ({})  {}".format(name, details, snippet)
+    return line if len(line) < termWidth - 8 else line[:termWidth - 11] + "..."
+
+
+def select_save(page_size=20):
+    """
+    Lists the saves from the catalog, newest first, a page at a time. Typing text instead of a number only lists
+    the saves whose name or context contains it. Returns the path of the chosen save, or None.
+    """
+    query, page = "", 0
+    while True:
+        saves, total = save_catalog.search(query, page * page_size, page_size)
+        if not total:
+            output("No saves{}. ".format(" matching " + query if query else ""), "error")
+            if not query:
+                return None
+            query, page = "", 0
+            continue
+        output("Saves {}-{} of {}{}".format(page * page_size + 1, page * page_size + len(saves), total,
+                                             ", matching " + query if query else ""), "menu")
+        choices = [describe_save(path, mtime, turns, snippet) for path, mtime, size, turns, snippet in saves]
+        more = (page + 1) * page_size < total
+        extra = (["(Next page)"] if more else []) + (["(Previous page)"] if page > 0 else []) + \
+            (["(Show all)"] if query else []) + ["(Cancel)"]
+        list_items(choices + extra, "menu")
+        bell()
+        print()
+        val = input_line("Enter a number from above (default 0), or text to search for: ", "selection-prompt").strip()
+        if not val:
+            return saves[0][0]
+        if not re.match(r"^\d+$", val):
+            query, page = val, 0
+            continue
+        i = int(val)
+        if i < len(saves):
+            return saves[i][0]
+        if i >= len(choices) + len(extra):
+            output("Invalid choice. ", "error")
+            continue
+        action = extra[i - len(choices)]
+        if action == "(Next page)":
+            page += 1
+        elif action == "(Previous page)":
+            page -= 1
+        elif action == "(Show all)":
+            query, page = "", 0
+        else:
+            return None
+
+
 def alter_text(text):
     if use_ptoolkit():
         return edit_multiline(text).strip()
@@ -365,7 +520,7 @@ def print_intro():
 
 class GameManager:
 
-    def __init__(self, gen: GPT2Generator):
+    def __init__(self, gen: 'GPT2Generator'):
         self.generator = gen
         self.story, self.context, self.prompt = None, None, None
 
@@ -407,10 +562,11 @@ class GameManager:
                 try:
                     with open(Path("prompts", filename + ".txt"), "w", encoding="utf-8") as f:
                         f.write(self.context + "\n" + self.prompt)
+                    story_index.update_prompt(Path("prompts", filename + ".txt"))
                 except IOError:
                     output("Permission error! Unable to save custom prompt. ", "error")
         elif new_game_option == 2:
-            story_file = select_file(Path("saves"), ".json")
+            story_file = select_save()
             if story_file:
                 self.story, self.context, self.prompt = load_story(story_file, self.generator)
             else:
@@ -440,6 +596,7 @@ class GameManager:
             instructions()
             output("Loading story...", "loading-message")
             self.story.print_story()
+            restore_past(self.story)
 
         if settings.getboolean("autosave"):
             save_story(self.story, file_override=self.story.savefile, autosave=True)
@@ -484,8 +641,11 @@ class GameManager:
             self.story.print_last()
 
         elif command == "menu":
+            save_writer.flush()
             if input_bool("Do you want to save? (y/N): ", "query"):
                 save_story(self.story)
+            elif settings.getboolean("autosave"):
+                save_past(self.story)
             # self.story, self.context, self.prompt = None, None, None
             return True
 
@@ -497,13 +657,22 @@ class GameManager:
             self.story = new_story(self.generator, self.story.context, self.prompt)
 
         elif command == "quit":
+            save_writer.flush()
             if input_bool("Do you want to save? (y/N): ", "query"):
                 save_story(self.story)
+            elif settings.getboolean("autosave"):
+                save_past(self.story)
             exit()
 
         elif command == "help":
             instructions()
 
+        elif command == "stats":
+            show_stats(args)
+
+        elif command == "find":
+            find_text(cmd_regex.group(2).strip())
+
         elif command == "print":
             use_wrap = input_bool("Print with wrapping? (y/N): ", "query")
             use_color = input_bool("Print with colors? (y/N): ", "query")
@@ -572,7 +741,7 @@ class GameManager:
             save_story(self.story)
 
         elif command == "load":
-            story_file = select_file(Path("saves"), ".json")
+            story_file = select_save()
             if story_file:
                 tstory, tcontext, tprompt = load_story(story_file, self.generator)
                 if tstory:
@@ -581,6 +750,7 @@ class GameManager:
                     self.context = tcontext
                     self.prompt = tprompt
                     self.story.print_story()
+                    restore_past(self.story)
                 else:
                     self.story.print_last()
             else:
@@ -719,8 +889,7 @@ class GameManager:
                 # TODO change this to two messages for different colors
                 output("Suggested actions:", "selection-value")
                 action_suggestion_lines = 2
-                for i in range(act_alts):
-                    suggested_action = self.story.get_suggestion()
+                for i, suggested_action in enumerate(self.story.get_suggestions(act_alts)):
                     if len(suggested_action.strip()) > 0:
                         j = len(suggested_actions)
                         suggested_actions.append(suggested_action)
@@ -758,26 +927,89 @@ class GameManager:
                 save_story(self.story, file_override=self.story.savefile, autosave=True)
 
 
+def show_stats(args):
+    """/stats: prints the generation spans and counters, turns recording on or off, or saves a Chrome trace."""
+    if args and args[0] in ("on", "off"):
+        tracer.enabled = args[0] == "on"
+        output("Instrumentation is " + args[0] + ". ", "message")
+    elif args and args[0] == "reset":
+        tracer.reset()
+        output("Statistics cleared. ", "message")
+    elif args and args[0] == "save":
+        path = args[1] if len(args) > 1 else datetime.now().strftime("trace-%d-%m-%Y_%H%M%S.json")
+        try:
+            tracer.save_chrome_trace(path)
+            output("Trace saved to {}, open it in chrome://tracing or ui.perfetto.dev".format(path), "message")
+        except IOError:
+            output("Could not write " + path, "error")
+    elif args:
+        output("Usage: /stats [on|off|reset|save FILE]", "error")
+    else:
+        if not tracer.enabled:
+            output("Instrumentation is off, turn it on with /stats on or the instrumentation setting. ", "message")
+        output('\n'.join(tracer.summary()), "message", wrap=False)
+
+
+def find_text(text):
+    """/find: lists the saves and prompts that contain all the words of text."""
+    if not text:
+        output("Usage: /find WORDS, \"quoted words\" are found as a phrase", "error")
+        return
+    if not story_index.refreshed.is_set():
+        output("Still indexing the saves, some may be missing from the results. ", "message")
+    matches = story_index.search(text)
+    if matches is None:
+        output("Could not search the saves. ", "error")
+        return
+    if not matches:
+        output("Nothing found. ", "message")
+    for match in matches:
+        output(describe_match(*match), "message")
+
+
+def profile_startup(path):
+    """Loads the model in the foreground, runs it once and reports how long each phase of starting took."""
+    generator = get_generator()
+    with startup.phase("first forward pass"):
+        generator.warmup()
+    startup.report(path)
+    output("Startup profile written to " + path, "message")
+
+
 # This is here for rapid development, without reloading the model. You import play into a jupyternotebook with autoreload
 if __name__ == "__main__":
+    # --profile-startup[=file.json] reports the startup time and exits
+    profile_arg = next((arg for arg in sys.argv[1:] if arg.startswith("--profile-startup")), None)
+    if profile_arg:
+        profile_startup(profile_arg.partition("=")[2] or "startup-profile.json")
+        exit(0)
     with open(Path("interface", "clover"), "r", encoding="utf-8") as file_:
         print(file_.read())
+    save_catalog.refresh_in_background()
+    story_index.refresh_in_background()
     try:
-        gm = GameManager(get_generator())
+        gm = GameManager(get_generator(background=settings.getboolean("background-load", True)))
         while True:
             # May be needed to avoid out of mem
             gc.collect()
-            torch.cuda.empty_cache()
+            if not isinstance(gm.generator, GeneratorHandle) or gm.generator.ready():
+                import torch
+                torch.cuda.empty_cache()
             print_intro()
             gm.play_story()
+            save_writer.flush()
     except KeyboardInterrupt:
         output("Quitting game.", "message")
+        save_writer.flush()
         if gm and gm.story:
             if input_bool("Do you want to save? (y/N): ", "query"):
                 save_story(gm.story)
+            elif settings.getboolean("autosave"):
+                save_past(gm.story)
     except Exception:
         traceback.print_exc()
         output("A fatal error has occurred. ", "error")
+        save_writer.flush()
         if gm and gm.story:
             if not gm.story.savefile or len(gm.story.savefile.strip()) == 0:
                 savefile = datetime.now().strftime("crashes/%d-%m-%Y_%H%M%S")
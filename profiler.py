@@ -0,0 +1,141 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+
+class StartupProfile:
+    """
+    Wall time of the phases of starting the game, in the order they finished.
+    Always recorded, it costs nothing; play.py --profile-startup prints and saves them.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - start))
+
+    def total(self):
+        return time.perf_counter() - self.start
+
+    def to_dict(self):
+        return {
+            "phases": [{"name": name, "seconds": round(seconds, 4)} for name, seconds in self.phases],
+            "total_seconds": round(self.total(), 4),
+        }
+
+    def report(self, path=None):
+        """Prints the breakdown, and writes it as json to path if given."""
+        total = self.total()
+        width = max([len(name) for name, _ in self.phases] + [5])
+        for name, seconds in self.phases:
+            print("{}  {:8.3f}s  {:5.1f}%".format(name.ljust(width), seconds, 100 * seconds / total))
+        print("{}  {:8.3f}s".format("total".ljust(width), total))
+        if path:
+            with open(path, 'w') as f:
+                json.dump(self.to_dict(), f, indent=2)
+
+
+startup = StartupProfile()
+
+
+class Span:
+    __slots__ = ('tracer', 'name', 'start')
+
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.tracer.synchronize is not None:
+            self.tracer.synchronize()
+        self.tracer.add_span(self.name, self.start, time.perf_counter())
+
+
+class Tracer:
+    """
+    Optional spans and counters recorded while generating, exported as a Chrome trace (chrome://tracing or
+    ui.perfetto.dev) or summarized by /stats.
+    While disabled, span() returns one shared do-nothing context manager and count() returns right away, so the
+    instrumented code only pays for a call and a flag check.
+    synchronize, if set, is called at the end of every span so asynchronous (cuda) work is timed where it's queued.
+    """
+
+    def __init__(self, enabled=False, max_events=200000):
+        self.enabled = enabled
+        self.max_events = max_events
+        self.synchronize = None
+        self.reset()
+
+    def reset(self):
+        self.origin = time.perf_counter()
+        self.events = []
+        self.dropped = 0
+        self.totals = {}  # span name: [count, seconds]
+        self.counters = {}
+
+    def span(self, name):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name)
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        self.counters[name] = self.counters.get(name, 0) + n
+        self.add_event({"name": name, "ph": "C", "ts": self.timestamp(time.perf_counter()),
+                        "pid": os.getpid(), "args": {name: self.counters[name]}})
+
+    def timestamp(self, t):
+        """Microseconds since the last reset, as Chrome traces want."""
+        return round((t - self.origin) * 1e6, 1)
+
+    def add_span(self, name, start, end):
+        total = self.totals.setdefault(name, [0, 0.0])
+        total[0] += 1
+        total[1] += end - start
+        self.add_event({"name": name, "ph": "X", "ts": self.timestamp(start), "dur": round((end - start) * 1e6, 1),
+                        "pid": os.getpid(), "tid": threading.get_ident()})
+
+    def add_event(self, event):
+        if len(self.events) < self.max_events:
+            self.events.append(event)
+        else:
+            self.dropped += 1
+
+    def summary(self):
+        """Lines of text: time per span name, slowest first, then the counters."""
+        if not self.totals and not self.counters:
+            return ["Nothing recorded yet."]
+        width = max([len(name) for name in list(self.totals) + list(self.counters)] + [4])
+        lines = ["{}  {:>7}  {:>10}  {:>9}".format("span".ljust(width), "count", "total ms", "mean ms")]
+        for name, (count, seconds) in sorted(self.totals.items(), key=lambda item: -item[1][1]):
+            lines.append("{}  {:7d}  {:10.1f}  {:9.3f}".format(name.ljust(width), count, seconds * 1e3,
+                                                               seconds * 1e3 / count))
+        for name, value in sorted(self.counters.items()):
+            lines.append("{}  {:7d}".format(name.ljust(width), value))
+        if self.dropped:
+            lines.append("{} events past the first {} were not kept for the trace".format(self.dropped,
+                                                                                           self.max_events))
+        return lines
+
+    def save_chrome_trace(self, path):
+        with open(path, 'w') as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms",
+                       "otherData": {"dropped_events": self.dropped}}, f)
+
+
+NULL_SPAN = nullcontext()
+tracer = Tracer()
@@ -0,0 +1,94 @@
+from pathlib import Path
+
+import torch
+from fastload import fingerprint, is_cached, parameters_on_meta, write_cached
+from getconfig import logger
+from gpt2 import Conv1D
+
+try:
+    from transformers.pytorch_utils import Conv1D as HFConv1D
+except ImportError:
+    from transformers.modeling_utils import Conv1D as HFConv1D
+
+QUANTIZE_MODES = ("off", "int8")
+# stored next to the checkpoint, the .json next to it holds what it was converted from
+CACHE_NAME = "quantized-int8-{}.pt"
+# what the cache holds, a different one is converted again. 2: the state_dict instead of the pickled model
+CACHE_FORMAT = 2
+
+
+def conv1d_to_linear(module):
+    """Replaces the (transposed) Conv1D layers of GPT-2 by equivalent Linear layers, so they can be quantized."""
+    for name, child in module.named_children():
+        if isinstance(child, (Conv1D, HFConv1D)):
+            nx, nf = child.weight.shape
+            linear = torch.nn.Linear(nx, nf)
+            linear.weight = torch.nn.Parameter(child.weight.data.t().contiguous())
+            linear.bias = child.bias
+            setattr(module, name, linear)
+        else:
+            conv1d_to_linear(child)
+    return module
+
+
+def quantize_int8(model):
+    """
+    Applies dynamic int8 quantization to the attention and MLP projections: weights are stored as int8 and
+    activations are quantized on the fly. The embeddings and the (tied) lm_head stay in float, so the logits the
+    sampler sees are computed at full precision. CPU only.
+    """
+    if 'fbgemm' not in torch.backends.quantized.supported_engines \
+            and 'qnnpack' in torch.backends.quantized.supported_engines:
+        torch.backends.quantized.engine = 'qnnpack'
+    conv1d_to_linear(model.transformer)
+    torch.quantization.quantize_dynamic(model.transformer, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    return model
+
+
+def torch_load(path):
+    try:
+        return torch.load(str(path), map_location="cpu", weights_only=True)
+    except TypeError:  # torch < 1.13
+        return torch.load(str(path), map_location="cpu")
+
+
+def zeroed_model(model_class, checkpoint_path):
+    """The model of checkpoint_path with zeroed weights to load into, much quicker to make than random ones."""
+    config = model_class.config_class.from_pretrained(str(checkpoint_path))
+    with parameters_on_meta():
+        model = model_class(config)
+    for module in model.modules():
+        for name, param in module._parameters.items():
+            if param is not None:
+                module._parameters[name] = torch.nn.Parameter(torch.zeros(param.shape, dtype=param.dtype),
+                                                              requires_grad=param.requires_grad)
+    model.tie_weights()
+    return model
+
+
+def load_quantized(model_class, checkpoint_path):
+    """
+    Loads checkpoint_path as a dynamically quantized int8 model. The first load converts the checkpoint and caches
+    its weights next to it, later loads quantize a zeroed model the same way and load the cached weights into it,
+    unless the checkpoint changed since. Only tensors are cached, so the model is always the current code.
+    """
+    checkpoint_path = Path(checkpoint_path)
+    if not checkpoint_path.is_dir():
+        # a model name for the transformers hub, there is nowhere to keep a cache
+        return quantize_int8(model_class.from_pretrained(str(checkpoint_path)))
+
+    cache_path = checkpoint_path / CACHE_NAME.format(model_class.__name__)
+    expected = dict(fingerprint(checkpoint_path, model_class), format=CACHE_FORMAT)
+    if is_cached(cache_path, expected):
+        try:
+            logger.info("Loading int8 model from %s", cache_path)
+            model = quantize_int8(zeroed_model(model_class, checkpoint_path))
+            model.load_state_dict(torch_load(cache_path))
+            return model
+        except Exception as e:
+            logger.warning("Could not load %s, converting the model again: %s", cache_path, e)
+
+    logger.info("Converting %s to int8, this only happens once", checkpoint_path)
+    model = quantize_int8(model_class.from_pretrained(str(checkpoint_path)))
+    write_cached(cache_path, expected, lambda tmp_path: torch.save(model.state_dict(), str(tmp_path)))
+    return model
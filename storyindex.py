@@ -0,0 +1,197 @@
+#full text search over the saves and the prompts, used by the /find command
+#can also be run from the clover-edition directory: python storyindex.py [--rebuild] [--limit N] words to find
+import argparse
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+from catalog import save_files, save_stat
+from getconfig import logger
+from journal import SaveJournal, copy_state, diff
+
+# the parts of a save that are searched, the rest are settings
+FIELDS = ("context", "memory", "actions", "results")
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (path TEXT PRIMARY KEY, mtime REAL);
+CREATE TABLE IF NOT EXISTS entries (id INTEGER PRIMARY KEY, path TEXT, field TEXT, i INTEGER, text TEXT);
+CREATE INDEX IF NOT EXISTS entries_path ON entries (path, field, i);
+CREATE VIRTUAL TABLE IF NOT EXISTS entries_fts USING fts5(text, content='entries', content_rowid='id');
+CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN
+    INSERT INTO entries_fts (rowid, text) VALUES (new.id, new.text);
+END;
+CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN
+    INSERT INTO entries_fts (entries_fts, rowid, text) VALUES ('delete', old.id, old.text);
+END;
+"""
+
+
+def match_query(text):
+    """Turns what the player typed into an FTS5 query: every word has to be there, "quoted words" as a phrase."""
+    phrases = [' '.join(re.findall(r"\w+", phrase)) for phrase in re.findall(r'"([^"]*)"', text)]
+    words = re.findall(r"\w+", re.sub(r'"[^"]*"', ' ', text))
+    return ' '.join('"' + term + '"' for term in phrases + words if term)
+
+
+class StoryIndex:
+    """
+    Full text search over every context, memory, action and result of the saves, and over the prompt files,
+    in a sqlite FTS5 index kept in saves/.search.db.
+    update_save() is called after each save. The first time a save is seen in a session it's indexed whole, after
+    that only the entries the journal's diff says changed, so a turn costs about the same however long the story.
+    refresh() catches up with the files changed outside of the game, by their modified time.
+    """
+
+    def __init__(self, saves=Path("saves"), prompts=Path("prompts")):
+        self.saves = Path(saves)
+        self.prompts = Path(prompts)
+        self.path = self.saves / '.search.db'
+        self.indexed = {}  # path: the fields of the save as they were last indexed in this session
+        # update_save() runs on the save writer's thread, refresh() on its own
+        self.lock = threading.RLock()
+        self.refreshed = threading.Event()
+        self.thread = None
+        self.created = False
+
+    @contextmanager
+    def connect(self):
+        self.saves.mkdir(parents=True, exist_ok=True)
+        db = sqlite3.connect(str(self.path), timeout=30)
+        try:
+            if not self.created:
+                db.executescript(SCHEMA)
+                self.created = True
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def insert(self, db, key, field, start, texts):
+        db.executemany("INSERT INTO entries (path, field, i, text) VALUES (?, ?, ?, ?)",
+                       [(key, field, start + i, text) for i, text in enumerate(texts) if text and text.strip()])
+
+    def forget(self, db, key):
+        db.execute("DELETE FROM entries WHERE path = ?", (key,))
+        db.execute("DELETE FROM sources WHERE path = ?", (key,))
+        self.indexed.pop(key, None)
+
+    def update_save(self, path, state):
+        """Indexes the save at path, which now holds state (a Story.to_dict())."""
+        key = Path(path).as_posix()
+        fields = {field: state.get(field) or ("" if field == "context" else []) for field in FIELDS}
+        try:
+            with self.lock, self.connect() as db:
+                if key not in self.indexed:
+                    self.forget(db, key)
+                for record in diff(self.indexed.get(key, {}), fields):
+                    field = record.get("splice") or record.get("set")
+                    at = record.get("at", 0)
+                    db.execute("DELETE FROM entries WHERE path = ? AND field = ? AND i >= ?", (key, field, at))
+                    texts = record["items"] if "splice" in record else record["value"]
+                    self.insert(db, key, field, at, texts if isinstance(texts, list) else [texts])
+                db.execute("INSERT OR REPLACE INTO sources VALUES (?, ?)", (key, save_stat(Path(path))[0]))
+                self.indexed[key] = copy_state(fields)
+        except (OSError, sqlite3.Error) as e:
+            logger.warning("Could not update the search index for %s: %s", path, e)
+
+    def update_prompt(self, path):
+        key = Path(path).as_posix()
+        try:
+            text = Path(path).read_text(encoding="utf-8", errors="replace")
+            with self.lock, self.connect() as db:
+                self.forget(db, key)
+                self.insert(db, key, "prompt", 0, [text])
+                db.execute("INSERT OR REPLACE INTO sources VALUES (?, ?)", (key, Path(path).stat().st_mtime))
+        except (OSError, sqlite3.Error) as e:
+            logger.warning("Could not update the search index for %s: %s", path, e)
+
+    def refresh(self):
+        """Indexes the saves and prompts that changed since they were indexed, and forgets the ones that are gone."""
+        try:
+            with self.lock, self.connect() as db:
+                known = dict(db.execute("SELECT path, mtime FROM sources"))
+            found = set()
+            saves = save_files(self.saves) if self.saves.exists() else []
+            for path in saves:
+                key = path.as_posix()
+                found.add(key)
+                if known.get(key) != save_stat(path)[0]:
+                    try:
+                        state = SaveJournal(path).load()
+                    except (OSError, ValueError) as e:
+                        logger.warning("Could not read %s for the search index: %s", path, e)
+                        continue
+                    with self.lock:
+                        self.indexed.pop(key, None)
+                        self.update_save(path, state)
+            prompts = self.prompts.rglob('*.txt') if self.prompts.exists() else []
+            for path in prompts:
+                key = path.as_posix()
+                found.add(key)
+                if known.get(key) != path.stat().st_mtime:
+                    self.update_prompt(path)
+            with self.lock, self.connect() as db:
+                for key in known:
+                    if key not in found:
+                        self.forget(db, key)
+        except (OSError, sqlite3.Error) as e:
+            logger.warning("Could not update the search index: %s", e)
+        finally:
+            self.refreshed.set()
+
+    def refresh_in_background(self):
+        self.thread = threading.Thread(target=self.refresh, name="story-index", daemon=True)
+        self.thread.start()
+
+    def rebuild(self):
+        with self.lock, self.connect() as db:
+            db.execute("DELETE FROM entries")
+            db.execute("DELETE FROM sources")
+            db.execute("INSERT INTO entries_fts (entries_fts) VALUES ('rebuild')")
+            self.indexed = {}
+        self.refresh()
+
+    def search(self, text, limit=20):
+        """
+        The best matches for text, as (path, field, index, snippet) with the matching words in [brackets].
+        None if the index can't be searched, no FTS5 in this sqlite or the database is locked, which is logged.
+        """
+        query = match_query(text)
+        if not query:
+            return []
+        try:
+            with self.connect() as db:
+                return db.execute(
+                    "SELECT entries.path, entries.field, entries.i, snippet(entries_fts, 0, '[', ']', '...', 16)"
+                    " FROM entries_fts JOIN entries ON entries.id = entries_fts.rowid"
+                    " WHERE entries_fts MATCH ? ORDER BY rank LIMIT ?", (query, limit)).fetchall()
+        except (OSError, sqlite3.Error) as e:
+            logger.warning("Could not search the index for %r: %s", text, e)
+            return None
+
+
+def describe_match(path, field, i, snippet):
+    if field in ("actions", "results"):
+        where = "{}, turn {}".format(path, i + 1)
+    elif field == "memory":
+        where = "{}, memory {}".format(path, i + 1)
+    else:
+        where = "{}, {}".format(path, field)
+    return where + ": " + ' '.join(snippet.split())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Searches the saves and the prompts.")
+    parser.add_argument('words', nargs='*', help='words to find, "quoted words" are found as a phrase')
+    parser.add_argument('--limit', type=int, default=20)
+    parser.add_argument('--rebuild', action='store_true', help="index everything again from scratch")
+    args = parser.parse_args()
+    index = StoryIndex()
+    if args.rebuild:
+        index.rebuild()
+    else:
+        index.refresh()
+    if args.words:
+        for match in index.search(' '.join(args.words), args.limit) or []:
+            print(describe_match(*match))
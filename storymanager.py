@@ -16,13 +16,18 @@ class Story:
         self.actions = []
         self.results = []
         self.savefile = ""
+        # the SaveJournal savefile was last loaded from or saved to, it knows what's already on disk
+        self.journal = None
+        # token ids of the prompt and of the story chunks, each stored with the text it encodes
+        # so edits made through /alter, /context, /remember, /forget etc. are noticed and re-encoded
+        self.prompt_tokens = {}
+        self.chunk_tokens = []
 
     def act(self, action, record=True, format=True):
         assert (self.context.strip() + action.strip())
         assert (settings.getint('top-keks') is not None)
         result = self.generator.generate(
-            self.get_story() + action,
-            self.context + ' '.join(self.memory),
+            context_tokens=self.get_context_tokens(action, self.context + ' '.join(self.memory)),
             temperature=settings.getfloat('temp'),
             top_p=settings.getfloat('top-p'),
             top_k=settings.getint('top-keks'),
@@ -66,19 +71,74 @@ class Story:
         lines = [val for pair in zip(self.actions, self.results) for val in pair]
         return '\n\n'.join(lines)
 
+    def get_line(self, i):
+        """The i-th entry of get_story(), alternating actions and results."""
+        return self.actions[i // 2] if i % 2 == 0 else self.results[i // 2]
+
+    def get_context_tokens(self, suffix, prompt):
+        """
+        The model input for prompt followed by get_story() + suffix, the same tokens memory_merge gives.
+        Story entries are encoded once and the window is filled from the end of the story, so the cost of a turn
+        doesn't grow with the length of the story.
+        """
+        if prompt not in self.prompt_tokens:
+            if len(self.prompt_tokens) > 4:
+                self.prompt_tokens = {}
+            self.prompt_tokens[prompt] = self.generator.encode_prompt(prompt)
+        whitespace = re.search(r'\s*$', prompt).group(0)
+        return self.generator.merge_chunks(self.prompt_tokens[prompt], self.story_chunks(suffix, whitespace))
+
+    def story_chunks(self, suffix, whitespace):
+        """
+        Yields the token ids of get_story() + suffix in chunks, from the end backwards.
+        BPE never merges across a point where non-whitespace is followed by whitespace, so entries are encoded on
+        their own when they end in non-whitespace; otherwise they're encoded together with what follows.
+        The chunk holding suffix changes every turn and isn't cached.
+        """
+        lines = 2 * min(len(self.actions), len(self.results))
+        chunk, chunk_end = suffix, None
+        cacheable = not suffix
+        for i in range(lines - 1, -1, -1):
+            piece = ('\n\n' if i > 0 else whitespace) + self.get_line(i)
+            if chunk and chunk[0].isspace() and piece and not piece[-1].isspace():
+                yield self.encode_chunk(chunk, chunk_end)
+                chunk, chunk_end = '', None
+                cacheable = True
+            if chunk_end is None and cacheable:
+                chunk_end = i
+            chunk = piece + chunk
+        if lines == 0:
+            chunk = whitespace + chunk
+        yield self.encode_chunk(chunk, chunk_end, first=True)
+
+    def encode_chunk(self, text, end, first=False):
+        """Encodes a story chunk, reusing the stored tokens of the chunk ending at entry `end` if its text is unchanged."""
+        if end is None:
+            return self.generator.encode_story(text, first)
+        while len(self.chunk_tokens) <= end:
+            self.chunk_tokens.append((None, None))
+        if self.chunk_tokens[end][0] != (text, first):
+            self.chunk_tokens[end] = ((text, first), self.generator.encode_story(text, first))
+        return self.chunk_tokens[end][1]
+
     def revert(self):
         self.actions = self.actions[:-1]
         self.results = self.results[:-1]
 
     def get_suggestion(self):
-        return re.sub('\n.*', '',
-                      self.generator.generate_raw(
-                          self.get_story() + "\n\n> You",
-                          self.context,
-                          temperature=settings.getfloat('action-temp'),
-                          top_p=settings.getfloat('top-p'),
-                          top_k=settings.getint('top-keks'),
-                          repetition_penalty=1))
+        return self.get_suggestions(1)[0]
+
+    def get_suggestions(self, n):
+        # only the first line of each suggestion is kept, so a row can stop as soon as it starts a new one
+        suggestions = self.generator.generate_raw_batch(
+            context_tokens=self.get_context_tokens("\n\n> You", self.context),
+            num_samples=n,
+            temperature=settings.getfloat('action-temp'),
+            top_p=settings.getfloat('top-p'),
+            top_k=settings.getint('top-keks'),
+            repetition_penalty=1,
+            stop_strings=["\n"])
+        return [re.sub('\n.*', '', s) for s in suggestions]
 
     def __str__(self):
         return self.context + ' ' + self.get_story()
@@ -0,0 +1,69 @@
+#checks that the sdpa attention backend of the experimental GPT-2 gives the logits of the manual one: for a causal
+#prefill, a prefill on top of a cache and decoding, with and without the static cache and left padding
+#must be run from the clover-edition directory, like test-models.py
+#usage: python test-attention.py
+#exits with 1 if they differ. benchmark.py runs it along with its other checks
+import sys
+
+import torch
+from transformers import GPT2Config
+
+import gpt2
+
+TOLERANCE = 1e-4
+# how the 40 tokens are fed to the model: all at once, with no past, is the causal prefill sdpa runs fused
+STEPS = {
+    "causal prefill": [40],
+    "prefill on a cache": [25, 15],
+    "decode": [30] + [1] * 10,
+}
+
+
+def logits(model, input_ids, steps, attention_mask=None):
+    """Feeds input_ids in chunks of the given lengths, each on top of the cache of the ones before."""
+    past, chunks, start = None, [], 0
+    with torch.no_grad():
+        for n in steps:
+            mask = attention_mask[:, :start + n] if attention_mask is not None else None
+            out = model(input_ids=input_ids[:, start:start + n], past_key_values=past, attention_mask=mask,
+                        use_cache=True, return_dict=True)
+            chunks.append(out.logits)
+            past = out.past_key_values
+            start += n
+    return torch.cat(chunks, 1)
+
+
+def check_backends():
+    """Returns {case: largest difference between the backends' logits}, padding positions left out."""
+    torch.manual_seed(0)
+    config = GPT2Config(vocab_size=1000, n_positions=128, n_ctx=128, n_embd=64, n_layer=2, n_head=4)
+    model = gpt2.GPT2LMHeadModelExperimental(config).eval()
+    input_ids = torch.randint(0, config.vocab_size, (2, 40))
+    padded = torch.ones_like(input_ids)
+    padded[1, :10] = 0
+    diffs = {}
+    for name, steps in STEPS.items():
+        for static in (False, True):
+            model.enable_static_cache(static)
+            for attention_mask in (None, padded):
+                model.set_attention_backend("manual")
+                manual = logits(model, input_ids, steps, attention_mask)
+                model.set_attention_backend("sdpa")
+                fused = logits(model, input_ids, steps, attention_mask)
+                # padding rows attend to nothing, the backends make different garbage of them
+                kept = attention_mask.bool() if attention_mask is not None else torch.ones_like(padded).bool()
+                case = "{}/static={}/padded={}".format(name, static, attention_mask is not None)
+                diffs[case] = (manual - fused).abs()[kept].max().item()
+    return diffs
+
+
+if __name__ == '__main__':
+    if not gpt2.HAS_SDPA:
+        print("scaled_dot_product_attention needs torch 2.0 or newer, nothing to check")
+        sys.exit(0)
+    ok = True
+    for case, diff in check_backends().items():
+        ok = ok and diff <= TOLERANCE
+        print("sdpa_matches_manual/{:40} {} (max diff {:.2e})".format(case, "ok" if diff <= TOLERANCE else "FAILED",
+                                                                     diff))
+    sys.exit(0 if ok else 1)
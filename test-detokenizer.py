@@ -0,0 +1,81 @@
+#checks that StreamingDetokenizer, fed one token at a time, gives the text tokenizer.decode gives for the same tokens:
+#for tokens cutting multi-byte characters, invalid UTF-8 and special tokens, also when the stream is truncated
+#must be run from the clover-edition directory, like test-models.py
+#usage: python test-detokenizer.py [trials]
+#exits with 1 if they ever differ. benchmark.py runs it along with its other checks
+import json
+import random
+import sys
+import tempfile
+from pathlib import Path
+
+from transformers import GPT2Tokenizer
+
+from gpt2generator import StreamingDetokenizer
+
+try:
+    from transformers.models.gpt2.tokenization_gpt2 import bytes_to_unicode
+except ImportError:
+    from transformers.tokenization_gpt2 import bytes_to_unicode
+
+# tokens of two bytes, most of them halves of multi-byte characters
+PAIRS = [text.encode('utf-8')[start:start + 2] for text in ("é", "€", "𝄞", "ü ", " 日本")
+         for start in range(len(text.encode('utf-8')) - 1)]
+
+
+def write_tokenizer(path):
+    """A byte-level BPE with a token for every byte, some for pairs of them and <|endoftext|>."""
+    byte_encoder = bytes_to_unicode()
+    vocab = {s: i for i, s in enumerate(byte_encoder.values())}
+    merges = []
+    for pair in PAIRS:
+        a, b = byte_encoder[pair[0]], byte_encoder[pair[1]]
+        if a + b not in vocab:
+            merges.append(a + ' ' + b)
+            vocab[a + b] = len(vocab)
+    vocab["<|endoftext|>"] = len(vocab)
+    with open(Path(path, 'vocab.json'), 'w', encoding='utf-8') as f:
+        json.dump(vocab, f)
+    with open(Path(path, 'merges.txt'), 'w', encoding='utf-8') as f:
+        f.write('#version: 0.2\n' + '\n'.join(merges) + '\n')
+    return GPT2Tokenizer(str(Path(path, 'vocab.json')), str(Path(path, 'merges.txt')))
+
+
+def streamed(tokenizer, ids, keep=None):
+    """The text of ids fed one at a time, truncated to the first keep of them the way sample_sequence does."""
+    detokenizer = StreamingDetokenizer(tokenizer)
+    for token_id in ids:
+        detokenizer.add(token_id)
+    if keep is not None:
+        detokenizer.truncate(keep)
+    detokenizer.finish()
+    return detokenizer.text
+
+
+def check_detokenizer(tokenizer, trials=2000):
+    """Returns the cases where the streamed text differs from decode, as (ids, keep, streamed, decoded)."""
+    rng = random.Random(0)
+    multi_byte = list(range(0x80, 0x100))
+    failures = []
+    for trial in range(trials):
+        # mostly the bytes and tokens of multi-byte characters, so that cuts land inside them
+        pool = multi_byte if trial % 2 else list(range(len(tokenizer)))
+        ids = [rng.choice(pool) if rng.random() < 0.7 else rng.randrange(len(tokenizer))
+               for _ in range(rng.randint(1, 20))]
+        for keep in (None, rng.randint(0, len(ids))):
+            text = streamed(tokenizer, ids, keep)
+            expected = tokenizer.decode(ids[:keep] if keep is not None else ids, skip_special_tokens=True,
+                                        clean_up_tokenization_spaces=False)
+            if text != expected:
+                failures.append((ids, keep, text, expected))
+    return failures
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as directory:
+        tokenizer = write_tokenizer(directory)
+    failures = check_detokenizer(tokenizer, int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
+    print("streaming_detokenizer_matches_decode {}".format("FAILED on {}".format(len(failures)) if failures else "ok"))
+    for ids, keep, text, expected in failures[:5]:
+        print("    ids {} kept {}: streamed {!r}, decoded {!r}".format(ids, keep, text, expected))
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,109 @@
+#checks that a save journal loads back what was saved, also after a crash at the worst moments of saving: while
+#appending a record, and between replacing the snapshot and removing the journal it includes
+#must be run from the clover-edition directory, like test-models.py
+#usage: python test-journal.py
+#exits with 1 if a save doesn't load back. benchmark.py runs it along with its other checks
+import json
+import sys
+import tempfile
+from pathlib import Path
+from unittest import mock
+
+import journal
+from journal import SaveJournal
+
+
+def story(turns):
+    # a long context, so the journal stays smaller than the snapshot and is appended to
+    return {"temp": 0.4, "context": "You are a knight. " * 100, "memory": [],
+            "actions": ["action {}".format(i) for i in range(turns)],
+            "results": ["result {}".format(i) for i in range(turns)]}
+
+
+def edited(d):
+    d = journal.copy_state(d)
+    d["results"][0] = "an edited result"
+    d["memory"] = ["a memory"]
+    return d
+
+
+class Crash(Exception):
+    pass
+
+
+def crash_before_unlink(directory):
+    """
+    Appends 2 turns and an edit, then compacts a story that moved on since, crashing before the journal is removed,
+    then saves again.
+    """
+    path = Path(directory, "story.json")
+    save = SaveJournal(path)
+    save.save(story(1))
+    save.save(story(2))
+    save.save(edited(story(3)))
+    assert save.journal_path.exists(), "the turns should have been appended to the journal"
+    later = edited(story(5))
+    later["results"][0] = "edited again"
+    with mock.patch.object(Path, "unlink", side_effect=Crash):
+        try:
+            save.snapshot(later)
+        except Crash:
+            pass
+    assert save.journal_path.exists()
+    # then the game is started again, and goes on
+    save = SaveJournal(path)
+    loaded = save.load()
+    save.save(dict(loaded, actions=loaded["actions"] + ["action 5"], results=loaded["results"] + ["result 5"]))
+    after = edited(story(6))
+    after["results"][0] = "edited again"
+    return later, loaded, after, SaveJournal(path).load()
+
+
+def torn_record(directory):
+    """A crash while appending a record leaves part of a line, what came before it still loads."""
+    path = Path(directory, "story.json")
+    save = SaveJournal(path)
+    save.save(story(1))
+    save.save(story(2))
+    with save.journal_path.open('a', encoding='utf-8') as f:
+        f.write(json.dumps({"splice": "actions", "at": 2, "items": ["action 2"], "seq": 99})[:20])
+    loaded = SaveJournal(path).load()
+    save = SaveJournal(path)
+    save.load()
+    save.save(story(3))
+    return story(2), loaded, story(3), SaveJournal(path).load()
+
+
+def overwritten(directory):
+    """Saving a new story over an old one, and crashing before the old journal is removed, loads the new story."""
+    path = Path(directory, "story.json")
+    save = SaveJournal(path)
+    save.save(story(5))
+    save.save(story(6))
+    new = SaveJournal(path)
+    new.save({"context": "", "memory": [], "actions": ["a new story"], "results": ["it begins"]})
+    new.save({"context": "", "memory": [], "actions": ["a new story", "on"], "results": ["it begins", "and on"]})
+    expected = {"context": "", "memory": [], "actions": ["a new story", "on"], "results": ["it begins", "and on"]}
+    return expected, SaveJournal(path).load(), expected, SaveJournal(path).load()
+
+
+CHECKS = {
+    "crash before removing the journal": crash_before_unlink,
+    "torn record": torn_record,
+    "new story over an old one": overwritten,
+}
+
+
+if __name__ == '__main__':
+    ok = True
+    for name, check in CHECKS.items():
+        with tempfile.TemporaryDirectory() as directory:
+            expected, loaded, expected_after, loaded_after = check(directory)
+        passed = loaded == expected and loaded_after == expected_after
+        ok = ok and passed
+        print("{:40} {}".format(name, "ok" if passed else "FAILED"))
+        for want, got in ((expected, loaded), (expected_after, loaded_after)):
+            for key in sorted(set(want) | set(got)):
+                if want.get(key) != got.get(key):
+                    print("    {}: expected {!r}, loaded {!r}".format(key, want.get(key), got.get(key)))
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,101 @@
+#a little script to compare the int8 quantized model with the 32 bit one on the cpu: speed, memory and how close the predictions are
+#must be run from the clover-edition directory, like test-models.py
+#usage: python test-quantize.py [model folder]
+#each mode runs in its own process so their memory use doesn't mix. The first int8 run also converts and caches the model
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+EVAL_TOKENS = 256
+DECODE_TOKENS = 64
+
+
+def rss_mb():
+    """Resident memory of this process, in MB."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10  # peak, not current, outside of linux
+
+
+def run(mode, model_path, logits_path):
+    from getconfig import settings
+    settings['force-cpu'] = 'on'
+    settings['quantize'] = mode
+    import torch
+    from gpt2generator import GPT2Generator
+
+    start = time.perf_counter()
+    gen = GPT2Generator(model_path=Path(model_path))
+    load_s = time.perf_counter() - start
+    model = gen.model
+
+    text = sorted(Path('prompts').rglob('*.txt'))[0].read_text(encoding='utf-8')
+    tokens = torch.tensor(gen.tokenizer.encode(text)[:EVAL_TOKENS + 1], dtype=torch.long)
+    with torch.no_grad():
+        # quality: next token predictions over a known text
+        start = time.perf_counter()
+        logits = model(input_ids=tokens[None, :-1], return_dict=True).logits[0].float()
+        prefill_s = time.perf_counter() - start
+        nll = torch.nn.functional.cross_entropy(logits, tokens[1:]).item()
+        torch.save(logits, logits_path)
+
+        # speed: greedy decoding with the kv cache
+        past = None
+        token = tokens[None, :1]
+        start = time.perf_counter()
+        for _ in range(DECODE_TOKENS):
+            out = model(input_ids=token, past_key_values=past, use_cache=True, return_dict=True)
+            past = out.past_key_values
+            token = out.logits[:, -1:].argmax(-1)
+        decode_s = time.perf_counter() - start
+
+    return {
+        "mode": mode,
+        "load_s": round(load_s, 2),
+        "rss_mb": round(rss_mb()),
+        "prefill_tok_s": round(tokens.numel() / prefill_s, 1),
+        "decode_tok_s": round(DECODE_TOKENS / decode_s, 1),
+        "perplexity": round(math.exp(nll), 3),
+    }
+
+
+def compare(model_path):
+    import torch
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in ('off', 'int8'):
+            logits_path = str(Path(tmp, mode + '.pt'))
+            out = subprocess.run([sys.executable, __file__, '--run', mode, model_path, logits_path],
+                                 stdout=subprocess.PIPE, check=True)
+            results[mode] = json.loads(out.stdout.decode().splitlines()[-1])
+            results[mode]['logits'] = torch.load(logits_path)
+
+    reference, quantized = results['off'].pop('logits'), results['int8'].pop('logits')
+    log_p = torch.log_softmax(reference, -1)
+    log_q = torch.log_softmax(quantized, -1)
+    agreement = (reference.argmax(-1) == quantized.argmax(-1)).float().mean().item()
+    kl = (log_p.exp() * (log_p - log_q)).sum(-1).mean().item()
+
+    print('\x1B[36m', end='')
+    for mode in ('off', 'int8'):
+        print(json.dumps(results[mode]))
+    print("top-1 agreement with 32 bit: {:.1%}    mean KL(32 bit || int8): {:.4f} nats".format(agreement, kl))
+    print("Speed and memory are measured on the cpu, over {} tokens of prefill and {} decoded tokens.".format(
+        EVAL_TOKENS, DECODE_TOKENS))
+    print("An agreement in the high 90s and a KL of a few hundredths means the int8 model picks the same words.")
+    print('\x1B[0m', end='')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--run':
+        print(json.dumps(run(*sys.argv[2:5])))
+    else:
+        compare(sys.argv[1] if len(sys.argv) > 1 else str(Path('models', 'pytorch-gpt2-xl-aid2-v5')))
@@ -0,0 +1,77 @@
+#checks that the candidate sampler keeps exactly the tokens top_k_top_p_filtering keeps, with the same logits
+#must be run from the clover-edition directory, like test-models.py
+#usage: python test-sampling.py [trials]
+#exits with 1 if they ever differ. benchmark.py runs it along with its other checks
+import sys
+
+import torch
+
+from gpt2generator import top_k_top_p_filtering, top_k_top_p_candidates
+
+VOCAB_SIZE = 50257
+# (top_k, top_p) pairs, the ones play.py is usually run with and the edges of the candidate set
+FILTERS = ((40, 0.0), (0, 0.9), (40, 0.9), (600, 0.5), (0, 0.999), (0, 0.5), (1, 0.9))
+
+
+def random_logits(trial):
+    scale = (0.5, 3, 10)[trial % 3]
+    logits = torch.randn(2, VOCAB_SIZE) * scale
+    if trial % 5 == 0:
+        logits[:, :50] = logits[:, :1]  # ties
+    return logits
+
+
+def mismatch(logits, top_k, top_p):
+    """
+    None if the candidate sampler falls back to top_k_top_p_filtering, else the largest difference between the logits
+    they keep, inf if they don't keep the same tokens.
+    """
+    reference = top_k_top_p_filtering(logits.clone(), top_k=top_k, top_p=top_p)
+    candidates = top_k_top_p_candidates(logits, top_k=top_k, top_p=top_p)
+    if candidates is None:
+        return None
+    values, indices = candidates
+    filtered = torch.full_like(logits, -float("Inf")).scatter(-1, indices, values)
+    if not torch.equal(torch.isinf(filtered), torch.isinf(reference)):
+        return float("inf")
+    kept = ~torch.isinf(reference)
+    return (filtered[kept] - reference[kept]).abs().max().item() if kept.any() else 0.0
+
+
+def near_cut_filters(logits):
+    """top_p values right at, and a float32 step on either side of, cumulative probabilities of the sorted logits."""
+    sorted_logits, _ = torch.sort(logits[0], descending=True)
+    cumulative_probs = torch.cumsum(torch.softmax(sorted_logits, dim=-1), dim=-1)
+    for i in (0, 1, 10, 100, 400):
+        p = cumulative_probs[i].item()
+        for top_p in (p, torch.tensor(p).nextafter(torch.tensor(2.)).item(),
+                      torch.tensor(p).nextafter(torch.tensor(0.)).item()):
+            if 0 < top_p < 1:
+                yield 0, top_p
+
+
+def check_candidates(trials=200):
+    """Returns the largest difference seen, and how many cases were compared and how many fell back."""
+    torch.manual_seed(0)
+    worst, compared, fell_back = 0.0, 0, 0
+    for trial in range(trials):
+        logits = random_logits(trial)
+        filters = FILTERS + tuple(near_cut_filters(logits)) if trial % 10 == 0 else FILTERS
+        for top_k, top_p in filters:
+            diff = mismatch(logits, top_k, top_p)
+            if diff is None:
+                fell_back += 1
+                continue
+            if diff > 0:
+                print("top_k={} top_p={!r} differs on trial {} (max diff {:.2e})".format(top_k, top_p, trial, diff))
+            worst = max(worst, diff)
+            compared += 1
+    return worst, compared, fell_back
+
+
+if __name__ == '__main__':
+    worst, compared, fell_back = check_candidates(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
+    ok = compared > 0 and worst == 0.0
+    print("candidates_match_filtering {} over {} cases, {} fell back to sorting the vocabulary (max diff {:.2e})"
+          .format("ok" if ok else "FAILED", compared, fell_back, worst))
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,175 @@
+#checks that the text functions rewritten for speed give exactly the results of the implementations they replaced,
+#which are kept here as the reference: the pronoun mappings, and the death and victory checks, also while streamed
+#must be run from the clover-edition directory, like test-models.py
+#usage: python test-text.py [number of random texts]
+#exits with 1 if they ever differ. benchmark.py runs it along with its other checks
+import random
+import re
+import sys
+from pathlib import Path
+
+import utils
+from utils import first_to_second_mappings, second_to_first_mappings, mapping_variation_pairs, \
+    replace_outside_quotes, standardize_punctuation
+
+FILLER = "he she they it the a sword door said and to was is are were were not here there now then".split()
+WORDS = sorted({word for pair in first_to_second_mappings + second_to_first_mappings for word in pair}) + FILLER
+# what can follow a word: the mappings care about spaces, , ? ! . and quotes, straight or curly
+ENDINGS = ["", "", "", "", "", ".", ",", "?", "!", "'s", '"', "’", "“", "”", "\n"]
+STARTS = ["", "", "", "", "", '"', "“", "`"]
+OUTCOME_WORDS = ("you you you you're you've are have dead killed slain no more nonexistent die pass away perish "
+                 "suffocate drown bleed out died perished suffocated drowned been yourself to death collapse choke "
+                 "choked choking dissolve and cease exist live happily ever after forever eternally for eternity "
+                 "become turn into a now deity god immortal go get in at arrive heaven paradise celebrate your "
+                 "victory triumph retire the he slowly").split()
+OUTCOME_SEPARATORS = [" ", " ", " ", " ", " ", ". ", ", ", "'", "! ", "\n", "  "]
+
+
+def reference_person(text, mappings):
+    """first_to_second_person and second_to_first_person before PronounMapper."""
+    text = " " + text
+    text = standardize_punctuation(text)
+    if text[-1] not in [".", "?", "!"]:
+        text += "."
+    for pair in mappings:
+        for variation in mapping_variation_pairs(pair):
+            text = replace_outside_quotes(text, variation[0], variation[1])
+    return text
+
+
+def reference_is_person(text, mappings):
+    """is_first_person and is_second_person before PronounMapper."""
+    count = 0
+    for pair in mappings:
+        for variation in mapping_variation_pairs(pair):
+            reg_expr = re.compile(variation[0] + '(?=([^"]*"[^"]*")*[^"]*$)')
+            count += len(re.findall(reg_expr, text))
+    return count > 3
+
+
+def reference_player_died(text):
+    """player_died before PhraseMatcher."""
+    lower_text = text.lower()
+    you_dead_regexps = [
+        "you('re| are) (dead|killed|slain|no more|nonexistent)",
+        "you (die|pass away|perish|suffocate|drown|bleed out)",
+        "you('ve| have) (died|perished|suffocated|drowned|been (killed|slain))",
+        r"you (\w* )?(yourself )?to death",
+        r"you (\w* )*(collapse|bleed out|chok(e|ed|ing)|drown|dissolve) (\w* )*and (die(|d)|pass away|cease to exist|(\w* )+killed)",
+    ]
+    return any(re.search(regexp, lower_text) for regexp in you_dead_regexps)
+
+
+def reference_player_won(text):
+    """player_won before PhraseMatcher."""
+    lower_text = text.lower()
+    won_phrases = [
+        r"you ((\w* )*and |)live happily ever after",
+        r"you ((\w* )*and |)live (forever|eternally|for eternity)",
+        r"you ((\w* )*and |)(are|become|turn into) ((a|now) )?(deity|god|immortal)",
+        r"you ((\w* )*and |)((go|get) (in)?to|arrive (at|in)) (heaven|paradise)",
+        r"you ((\w* )*and |)celebrate your (victory|triumph)",
+        r"you ((\w* )*and |)retire",
+    ]
+    return any(re.search(regexp, lower_text) for regexp in won_phrases)
+
+
+def pieces(text):
+    """text cut in a few random places, the same ones every time, as if it was streamed."""
+    rng = random.Random(text)
+    cuts = sorted(rng.sample(range(1, len(text)), min(len(text) - 1, rng.randint(0, 16)))) if len(text) > 1 else []
+    bounds = [0] + cuts + [len(text)]
+    return [text[start:end] for start, end in zip(bounds, bounds[1:])]
+
+
+def watch(text):
+    """What an OutcomeWatcher says once text was fed to it in pieces."""
+    watcher = utils.OutcomeWatcher()
+    for piece in pieces(text):
+        watcher.feed(piece)
+    return watcher.outcome
+
+
+def reference_watch(text):
+    """What the watcher should say: the outcome the reference finds first as the pieces come in, death first."""
+    streamed = ""
+    for piece in pieces(text):
+        streamed += piece
+        if reference_player_died(streamed):
+            return "died"
+        if reference_player_won(streamed):
+            return "won"
+    return None
+
+
+def random_text(rng):
+    words = []
+    for _ in range(rng.randint(1, 40)):
+        word = rng.choice(WORDS)
+        if rng.random() < 0.2:
+            word = utils.capitalize(word)
+        words.append(rng.choice(STARTS) + word + rng.choice(ENDINGS))
+    return rng.choice([" ", " ", " ", "  "]).join(words)
+
+
+def random_outcome_text(rng):
+    # short enough for the nested groups of the reference to finish quickly
+    text = "".join(rng.choice(OUTCOME_WORDS) + rng.choice(OUTCOME_SEPARATORS) for _ in range(rng.randint(1, 30)))
+    return utils.capitalize(text) if rng.random() < 0.3 else text
+
+
+def pronoun_corpus(n):
+    """The lines of the prompts, n random texts, then long ones: whole stories, full of quotes."""
+    for path in sorted(Path('prompts').rglob('*.txt')):
+        yield from (line for line in path.read_text(encoding='utf-8').splitlines() if line.strip())
+    rng = random.Random(0)
+    for _ in range(n):
+        yield random_text(rng)
+    for _ in range(max(n // 200, 1)):
+        yield " ".join(random_text(rng) for _ in range(100))
+
+
+def outcome_corpus(n):
+    rng = random.Random(1)
+    for _ in range(n):
+        yield random_outcome_text(rng)
+
+
+PRONOUN_CHECKS = {
+    "first_to_second_person": (utils.first_to_second_person,
+                               lambda text: reference_person(text, first_to_second_mappings)),
+    "second_to_first_person": (utils.second_to_first_person,
+                               lambda text: reference_person(text, second_to_first_mappings)),
+    "is_first_person": (utils.is_first_person, lambda text: reference_is_person(text, first_to_second_mappings)),
+    "is_second_person": (utils.is_second_person, lambda text: reference_is_person(text, second_to_first_mappings)),
+}
+OUTCOME_CHECKS = {
+    "player_died": (utils.player_died, reference_player_died),
+    "player_won": (utils.player_won, reference_player_won),
+    "OutcomeWatcher": (watch, reference_watch),
+}
+
+
+def check_text(checks, texts):
+    """Returns {function name: [texts it got wrong]} and how many texts were compared."""
+    failures = {name: [] for name in checks}
+    count = 0
+    for text in texts:
+        count += 1
+        for name, (function, reference) in checks.items():
+            if function(text) != reference(text):
+                failures[name].append(text)
+    return failures, count
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    ok = True
+    for checks, texts in ((PRONOUN_CHECKS, pronoun_corpus(n)), (OUTCOME_CHECKS, outcome_corpus(n))):
+        failures, count = check_text(checks, texts)
+        for name, failed in failures.items():
+            print("{:25} {} over {} texts".format(name, "FAILED on {}".format(len(failed)) if failed else "ok", count))
+            for text in failed[:5]:
+                print("    {!r}".format(text))
+        ok = ok and not any(failures.values())
+    sys.exit(0 if ok else 1)
@@ -1,8 +1,10 @@
 # coding: utf-8
+import bisect
 import re
 
 import random
 import textwrap
+import time
 import os
 import sys
 
@@ -21,12 +23,29 @@ def getTermWidth():
 termWidth = getTermWidth()
 
 
+_notebook_detected = None
+
+
 def in_colab():
     """Some terminal codes don't work in a colab notebook."""
-    # from https://github.com/tqdm/tqdm/blob/master/tqdm/autonotebook.py
+    global _notebook_detected
     if settings.getboolean("colab-mode"):
         settings["prompt-toolkit"] = "off"
         return True
+    # this is called for every cleared line, so it's only probed once
+    if _notebook_detected is None:
+        _notebook_detected = detect_notebook()
+    if _notebook_detected:
+        settings["colab-mode"] = "on"
+        settings["prompt-toolkit"] = "off"
+    return _notebook_detected
+
+
+def detect_notebook():
+    # from https://github.com/tqdm/tqdm/blob/master/tqdm/autonotebook.py
+    if 'IPython' not in sys.modules:
+        # a notebook's kernel imported IPython long before this, importing it here would only cost half a second
+        return get_terminal_size()[0] == 0 or 'google.colab' in sys.modules
     try:
         from IPython import get_ipython
         if (not get_ipython()) or ('IPKernelApp' not in get_ipython().config):  # pragma: no cover
@@ -34,14 +53,8 @@ def in_colab():
         if 'VSCODE_PID' in os.environ:  # pragma: no cover
             raise ImportError("vscode")
     except ImportError:
-        if get_terminal_size()[0]==0 or 'google.colab' in sys.modules:
-            settings["colab-mode"] = "on"
-            settings["prompt-toolkit"] = "off"
-            return True
-        return False
+        return get_terminal_size()[0] == 0 or 'google.colab' in sys.modules
     else:
-        settings["colab-mode"] = "on"
-        settings["prompt-toolkit"] = "off"
         return True
 
 
@@ -167,6 +180,12 @@ def fill_text(text, width):
     return '\n'.join(texts)
 
 
+def wrap_width():
+    width = settings.getint("text-wrap-width")
+    width = 999999999 if width < 2 else width
+    return min(width, termWidth)
+
+
 # ECMA-48 set graphics codes for the curious. Check out "man console_codes"
 def output(text1, col1=None,
            text2=None, col2=None,
@@ -177,9 +196,7 @@ def output(text1, col1=None,
     ptoolkit = use_ptoolkit() and ptcolors['displaymethod'] == "prompt-toolkit"
 
     if wrap:
-        width = settings.getint("text-wrap-width")
-        width = 999999999 if width < 2 else width
-        width = min(width, termWidth)
+        width = wrap_width()
         wtext = text1 + '\u200D' + sep + '\u200D' + text2 if text2 is not None else text1
         wtext = fill_text(wtext, width)
         wtext = re.sub(r"\n[ \t]+", "\n", wtext) if rem_beg_spaces else wtext
@@ -229,6 +246,56 @@ def output(text1, col1=None,
     return linecount
 
 
+class StreamRenderer:
+    """
+    Shows text while it's being generated, the way output() would print it, and erases it with clear().
+    Only the rows that changed since the last frame are erased and printed again, and only the paragraphs whose
+    text changed are wrapped again, so a frame usually rewrites one row however long the text gets.
+    Frames are drawn at most stream-fps times a second. Needs cursor movement, so it's disabled in colab.
+    """
+
+    def __init__(self, col="ai-text", fps=None):
+        self.col = col
+        fps = settings.getint("stream-fps", 20) if fps is None else fps
+        self.enabled = fps > 0 and not in_colab()
+        self.interval = 1 / fps if fps > 0 else 0
+        self.last_frame = None
+        self.width = wrap_width()
+        self.paragraphs = []  # (text, rows) of the last frame
+        self.rows = []  # what's on the screen
+
+    def frame_due(self):
+        return self.enabled and (self.last_frame is None or time.perf_counter() - self.last_frame >= self.interval)
+
+    def wrap(self, paragraph):
+        rows = fill_text(paragraph, self.width)
+        return re.sub(r"\n[ \t]+", "\n", rows).split('\n')
+
+    def draw(self, text):
+        self.last_frame = time.perf_counter()
+        # output() starts with an empty line, the stream does too
+        paragraphs, rows = [], [""]
+        for i, paragraph in enumerate(text.split('\n')):
+            if i < len(self.paragraphs) and self.paragraphs[i][0] == paragraph:
+                paragraphs.append(self.paragraphs[i])
+            else:
+                paragraphs.append((paragraph, self.wrap(paragraph)))
+            rows += paragraphs[-1][1]
+        self.paragraphs = paragraphs
+
+        same = 0
+        while same < min(len(rows), len(self.rows)) and rows[same] == self.rows[same]:
+            same += 1
+        clear_lines(len(self.rows) - same)
+        if same < len(rows):
+            output('\n'.join(rows[same:]), self.col, wrap=False, beg='')
+        self.rows = rows
+
+    def clear(self):
+        clear_lines(len(self.rows))
+        self.paragraphs, self.rows = [], []
+
+
 def input_bool(prompt, col1="default", default: bool = False):
     val = input_line(prompt, col1).strip().lower()
     if not val or val[0] not in "yn":
@@ -403,34 +470,115 @@ def get_num_options(num):
             print("Error invalid choice. ")
 
 
+# anything that isn't part of words and spaces, which is all (\w* )* can match
+WORD_SEPARATOR = re.compile(r"[^\w ]")
+
+
+class PhraseMatcher:
+    r"""
+    Finds phrases like  you (\w* )*and die  without the backtracking of nested (\w* )* groups, which takes
+    seconds on long outputs that nearly match.
+    A phrase is a list of regexes searched one after the other, each from where the previous one ended and only
+    up to the end of the words and spaces the phrase started in, since that's all (\w* )* can cross. A regex
+    starting with (?<= ) must follow a space, as after (\w* )*. Following the earliest match of each part finds
+    a match whenever there is one, as long as no part can match inside another match of itself.
+    plain are ordinary regexes, searched as they are.
+    """
+
+    def __init__(self, plain, phrases):
+        self.plain = re.compile("|".join("(?:" + regexp + ")" for regexp in plain))
+        self.phrases = [[re.compile(part) for part in phrase] for phrase in phrases]
+
+    def search(self, text, pos=0):
+        """Whether the (lower case) text has a match starting at or after pos."""
+        if self.plain.search(text, pos):
+            return True
+        for first, *rest in self.phrases:
+            run_end = -1
+            for match in first.finditer(text, pos):
+                if match.start() < run_end:
+                    continue  # an earlier start in the same words and spaces was already followed
+                separator = WORD_SEPARATOR.search(text, match.end())
+                run_end = separator.start() if separator else len(text)
+                end = match.end()
+                for part in rest:
+                    match = part.search(text, end, run_end)
+                    if match is None:
+                        break
+                    end = match.end()
+                else:
+                    return True
+        return False
+
+
+death_matcher = PhraseMatcher(
+    plain=[
+        "you('re| are) (dead|killed|slain|no more|nonexistent)",
+        "you (die|pass away|perish|suffocate|drown|bleed out)",
+        "you('ve| have) (died|perished|suffocated|drowned|been (killed|slain))",
+        r"you (\w* )?(yourself )?to death",
+    ],
+    # you (\w* )*(collapse|bleed out|chok(e|ed|ing)|drown|dissolve) (\w* )*and (die(|d)|pass away|cease to exist|(\w* )+killed)
+    phrases=[
+        ["you ", "(?<= )(collapse|bleed out|chok(e|ed|ing)|drown|dissolve) ", "(?<= )and (die(|d)|pass away|cease to exist)"],
+        ["you ", "(?<= )(collapse|bleed out|chok(e|ed|ing)|drown|dissolve) ", "(?<= )and ", " killed"],
+    ],
+)
+
+# you ((\w* )*and |)<ending>
+won_endings = [
+    "live happily ever after",
+    "live (forever|eternally|for eternity)",
+    "(are|become|turn into) ((a|now) )?(deity|god|immortal)",
+    "((go|get) (in)?to|arrive (at|in)) (heaven|paradise)",
+    "celebrate your (victory|triumph)",
+    "retire",
+]
+won_matcher = PhraseMatcher(
+    plain=["you " + ending for ending in won_endings],
+    phrases=[["you ", "(?<= )and (" + "|".join(won_endings) + ")"]],
+)
+
+
 def player_died(text):
     """
     TODO: Add in more sophisticated NLP, maybe a custom classifier
     trained on hand-labelled data that classifies second-person
     statements as resulting in death or not.
     """
-    lower_text = text.lower()
-    you_dead_regexps = [
-        "you('re| are) (dead|killed|slain|no more|nonexistent)",
-        "you (die|pass away|perish|suffocate|drown|bleed out)",
-        "you('ve| have) (died|perished|suffocated|drowned|been (killed|slain))",
-        "you (\w* )?(yourself )?to death",
-        "you (\w* )*(collapse|bleed out|chok(e|ed|ing)|drown|dissolve) (\w* )*and (die(|d)|pass away|cease to exist|(\w* )+killed)",
-    ]
-    return any(re.search(regexp, lower_text) for regexp in you_dead_regexps)
+    return death_matcher.search(text.lower())
 
 
 def player_won(text):
-    lower_text = text.lower()
-    won_phrases = [
-        "you ((\w* )*and |)live happily ever after",
-        "you ((\w* )*and |)live (forever|eternally|for eternity)",
-        "you ((\w* )*and |)(are|become|turn into) ((a|now) )?(deity|god|immortal)",
-        "you ((\w* )*and |)((go|get) (in)?to|arrive (at|in)) (heaven|paradise)",
-        "you ((\w* )*and |)celebrate your (victory|triumph)",
-        "you ((\w* )*and |)retire",
-    ]
-    return any(re.search(regexp, lower_text) for regexp in won_phrases)
+    return won_matcher.search(text.lower())
+
+
+class OutcomeWatcher:
+    """
+    Checks text for player_died and player_won while it's streamed, so a death can be noticed before the whole
+    result is generated. feed() returns "died" or "won" once the text so far has one, None until then.
+    Only the end of the text is searched again: a match crosses at most one separator (the ' of you're), so it
+    can't start before the last two separators of the text that was already checked.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.separators = (-1, -1)
+        self.outcome = None
+
+    def feed(self, text):
+        if self.outcome is not None:
+            return self.outcome
+        window = self.separators[0] + 1
+        start = len(self.text)
+        self.text += text.lower()
+        for separator in WORD_SEPARATOR.finditer(self.text, start):
+            self.separators = (self.separators[1], separator.start())
+        if death_matcher.search(self.text, window):
+            self.outcome = "died"
+        elif won_matcher.search(self.text, window):
+            self.outcome = "won"
+        return self.outcome
 
 
 def cut_trailing_quotes(text):
@@ -534,33 +682,11 @@ def replace_outside_quotes(text, current_word, repl_word):
 
 
 def is_first_person(text):
-    count = 0
-    for pair in first_to_second_mappings:
-        variations = mapping_variation_pairs(pair)
-        for variation in variations:
-            reg_expr = re.compile(variation[0] + '(?=([^"]*"[^"]*")*[^"]*$)')
-            matches = re.findall(reg_expr, text)
-            count += len(matches)
-
-    if count > 3:
-        return True
-    else:
-        return False
+    return first_to_second_mapper.count(text, 3) > 3
 
 
 def is_second_person(text):
-    count = 0
-    for pair in second_to_first_mappings:
-        variations = mapping_variation_pairs(pair)
-        for variation in variations:
-            reg_expr = re.compile(variation[0] + '(?=([^"]*"[^"]*")*[^"]*$)')
-            matches = re.findall(reg_expr, text)
-            count += len(matches)
-
-    if count > 3:
-        return True
-    else:
-        return False
+    return second_to_first_mapper.count(text, 3) > 3
 
 
 def capitalize(word):
@@ -638,6 +764,83 @@ second_to_first_mappings = [
 ]
 
 
+QUOTE = re.compile('"')
+
+
+class PronounMapper:
+    """
+    Applies a mapping table outside of quotes, with exactly the result of calling replace_outside_quotes for every
+    variation of every pair in order, including how earlier replacements hide or expose words to later ones.
+    The patterns are compiled once, and instead of a lookahead rescanning the rest of the text for every match,
+    whether a match is outside of quotes is looked up in the positions of the quotes. No pattern or replacement
+    contains a quote, so matches starting inside a rejected match are rejected too and skipping over them is safe,
+    and a replacement only moves the quotes after it, by how much longer it is than what it replaced.
+    """
+
+    def __init__(self, mappings):
+        self.variations = []
+        words = set()
+        for pair in mappings:
+            words.update((pair[0], capitalize(pair[0])))
+            for pattern, repl in mapping_variation_pairs(pair):
+                # the replacements have no group references, so they expand to the same string for every match
+                self.variations.append((re.compile(pattern), re.sub('x', repl, 'x')))
+        # every pattern starts with a space and one of these, text without any is left as it is
+        self.any_word = re.compile(" (?:" + "|".join(sorted(words, key=len, reverse=True)) + ")")
+
+    @staticmethod
+    def quote_positions(text):
+        return [match.start() for match in QUOTE.finditer(text)]
+
+    @staticmethod
+    def shift(quotes, shifts):
+        """The quote positions after the replacements, shifts are (end of the replaced match, length added) in order."""
+        shifted, offset, i = [], 0, 0
+        for position in quotes:
+            while i < len(shifts) and shifts[i][0] <= position:
+                offset += shifts[i][1]
+                i += 1
+            shifted.append(position + offset)
+        return shifted
+
+    def apply(self, text):
+        if not self.any_word.search(text):
+            return text
+        quotes = self.quote_positions(text)
+        for pattern, repl in self.variations:
+            if not quotes:
+                text = pattern.sub(lambda match: repl, text)
+                continue
+            shifts = []
+
+            def outside_quotes(match):
+                if (len(quotes) - bisect.bisect_left(quotes, match.end())) % 2 == 0:
+                    shifts.append((match.end(), len(repl) - (match.end() - match.start())))
+                    return repl
+                return match.group()
+
+            text = pattern.sub(outside_quotes, text)
+            if any(added for _, added in shifts):
+                quotes = self.shift(quotes, shifts)
+        return text
+
+    def count(self, text, limit=None):
+        """Number of matches outside of quotes, as is_first_person counted them. Stops once past limit."""
+        quotes = self.quote_positions(text)
+        count = 0
+        for pattern, _ in self.variations:
+            for match in pattern.finditer(text):
+                if (len(quotes) - bisect.bisect_left(quotes, match.end())) % 2 == 0:
+                    count += 1
+            if limit is not None and count > limit:
+                break
+        return count
+
+
+first_to_second_mapper = PronounMapper(first_to_second_mappings)
+second_to_first_mapper = PronounMapper(second_to_first_mappings)
+
+
 def capitalize_helper(string):
     string_list = list(string)
     string_list[0] = string_list[0].upper()
@@ -667,11 +870,7 @@ def first_to_second_person(text):
     text = standardize_punctuation(text)
     if text[-1] not in [".", "?", "!"]:
         text += "."
-    for pair in first_to_second_mappings:
-        variations = mapping_variation_pairs(pair)
-        for variation in variations:
-            text = replace_outside_quotes(text, variation[0], variation[1])
-    return text
+    return first_to_second_mapper.apply(text)
 
 
 def second_to_first_person(text):
@@ -679,8 +878,4 @@ def second_to_first_person(text):
     text = standardize_punctuation(text)
     if text[-1] not in [".", "?", "!"]:
         text += "."
-    for pair in second_to_first_mappings:
-        variations = mapping_variation_pairs(pair)
-        for variation in variations:
-            text = replace_outside_quotes(text, variation[0], variation[1])
-    return text
+    return second_to_first_mapper.apply(text)